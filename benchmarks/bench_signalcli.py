@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the signalcli library against the fake signal-cli (signalcli/fake_signal_cli.py),
+so they can be run offline without a registered Signal account.
+
+    python benchmarks/bench_signalcli.py                  # all benchmarks
+    python benchmarks/bench_signalcli.py inbound --envelopes 50000
+    python benchmarks/bench_signalcli.py --json > results.json
+
+Reports inbound envelopes/sec, end-to-end callback latency percentiles (from the time the fake
+wrote the envelope until the callback ran), outbound sends/sec with round-trip latency
+percentiles, and the RSS of the benchmark process. The broadcast benchmark also checks that
+retries never write a request twice (the fake answers slower than the send timeout), and
+exits with an error if they do.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import signalcli
+from signalcli import fake_signal_cli
+
+
+def rss_mb():
+    """ Current resident set size of this process in MB """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    ## ru_maxrss is the peak, in KB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if sys.platform == "darwin" else maxrss / 1024.0
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return { "p" + str(p): samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] for p in points }
+
+
+async def create_signalcli(fake_opts, **kwargs):
+    os.environ["SIGNALCLI_FAKE_OPTS"] = fake_opts
+    sig = signalcli.Signalcli(user_name="+10000000000", bin_path=fake_signal_cli.PATH, event_loop=asyncio.get_running_loop(),
+        autostart=False, **kwargs)
+    await sig.start()
+    return sig
+
+
+async def bench_inbound(args):
+    """ Envelopes generated as fast as possible by the fake, counted in a trivial callback """
+    done = asyncio.get_running_loop().create_future()
+    latencies = []
+    state = { 'first': None }
+
+    def on_message(sigcli_obj, event_name, msg):
+        now = time.time()
+        if state['first'] is None:
+            state['first'] = time.perf_counter()
+        latencies.append(now - float(msg.message_body.split(" ", 2)[1]))
+        if len(latencies) == args.envelopes and not done.done():
+            done.set_result(time.perf_counter())
+
+    rss_before = rss_mb()
+    sig = await create_signalcli("--envelopes %d --envelope-rate %f --payload-size %d --groups %d --group-size %d --contacts %d" % (
+        args.envelopes, args.envelope_rate, args.payload_size, args.groups, args.group_size, args.contacts),
+        message_view=args.message_view, json_codec=args.json_codec)
+    sig.on('message', on_message)
+    end = await asyncio.wait_for(done, args.timeout)
+    elapsed = end - state['first']
+    result = {
+        "envelopes": len(latencies),
+        "envelopes_per_sec": len(latencies) / elapsed if elapsed > 0 else float("inf"),
+        "latency_ms": { k: v * 1000.0 for k, v in percentiles(latencies).items() },
+        "rss_mb": rss_mb(),
+        "rss_growth_mb": rss_mb() - rss_before,
+    }
+    await sig.stop()
+    return result
+
+
+async def bench_outbound(args):
+    """ Sends pipelined through send_message_async(), waiting for all responses """
+    sig = await create_signalcli("--contacts 100 --groups 0", json_codec=args.json_codec, outgoing_queue_size=args.window)
+    await asyncio.sleep(0.2)
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    futures = []
+    for i in range(args.sends):
+        futures.append(await sig.send_message_async("+1%010d" % (i % 100), "benchmark message %d" % i))
+    results = await asyncio.gather(*futures)
+    elapsed = time.perf_counter() - start
+    result = {
+        "sends": len(results),
+        "sends_per_sec": len(results) / elapsed,
+        "latency_ms": { k: v * 1000.0 for k, v in percentiles([r.latency for r in results]).items() },
+        "rss_mb": rss_mb(),
+        "rss_growth_mb": rss_mb() - rss_before,
+    }
+    await sig.stop()
+    return result
+
+
+async def bench_broadcast(args):
+    """ Broadcast with retries to recipients the fake answers too slowly, every recipient may get one write only """
+    sig = await create_signalcli("--contacts 100 --groups 0 --send-delay %f" % args.send_delay, json_codec=args.json_codec,
+        send_rate=args.broadcast_send_rate, send_burst=1, metrics=True)
+    await asyncio.sleep(0.2)
+    recipients = ["+1%010d" % i for i in range(args.recipients)]
+    start = time.perf_counter()
+    results = await sig.broadcast(recipients, "benchmark broadcast", retries=2, retry_backoff=0.05, timeout=args.broadcast_timeout)
+    elapsed = time.perf_counter() - start
+    written = sum(series['value'] for series in sig.get_metrics().get('signalcli_requests_written_total', []))
+    result = {
+        "recipients": len(results),
+        "succeeded": sum(1 for r in results if r.success),
+        "failed": sum(1 for r in results if not r.success),
+        "retried": sum(1 for r in results if r.attempts > 1),
+        "requests_written": written,
+        "duplicate_writes": max(0, written - len(results)),
+        "elapsed_sec": elapsed,
+    }
+    await sig.stop()
+    return result
+
+
+BENCHMARKS = {
+    "inbound": bench_inbound,
+    "outbound": bench_outbound,
+    "broadcast": bench_broadcast,
+}
+
+
+def print_result(name, result):
+    print(name)
+    for key, value in result.items():
+        if isinstance(value, dict):
+            value = "  ".join(k + "=" + "{0:.2f}".format(v) for k, v in value.items())
+        elif isinstance(value, float):
+            value = "{0:.2f}".format(value)
+        print("    {0:<20} {1}".format(key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", choices=[[]] + sorted(BENCHMARKS), help="Benchmarks to run (default all)")
+    parser.add_argument("--envelopes", type=int, default=20000)
+    parser.add_argument("--envelope-rate", type=float, default=0, help="Envelopes per second, 0 = as fast as possible")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--group-size", type=int, default=20)
+    parser.add_argument("--contacts", type=int, default=1000)
+    parser.add_argument("--sends", type=int, default=20000)
+    parser.add_argument("--window", type=int, default=1000, help="Outgoing queue size used for the outbound benchmark")
+    parser.add_argument("--recipients", type=int, default=100, help="Recipients of the broadcast benchmark")
+    parser.add_argument("--send-delay", type=float, default=0.02, help="Seconds the fake takes to answer each send in the broadcast benchmark")
+    parser.add_argument("--broadcast-timeout", type=float, default=0.5, help="Send timeout of the broadcast benchmark")
+    parser.add_argument("--broadcast-send-rate", type=float, default=100, help="send_rate of the broadcast benchmark")
+    parser.add_argument("--json-codec", default=None, help="json|orjson|msgspec (default: fastest installed)")
+    parser.add_argument("--message-view", action="store_true", help="Use MessageView objects in the inbound benchmark")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        results[name] = asyncio.run(BENCHMARKS[name](args))
+        if not args.json:
+            print_result(name, results[name])
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if any(result.get("duplicate_writes") for result in results.values()):
+        sys.exit("requests were written to signal-cli more than once")
+
+
+if __name__ == "__main__":
+    main()
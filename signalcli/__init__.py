@@ -1,3 +1,2 @@
-
 from .signalcli import Signalcli
-
+from .pool import SignalcliPool
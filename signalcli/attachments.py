@@ -0,0 +1,312 @@
+
+import os
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import mimetypes
+import collections
+import concurrent.futures
+
+
+class Attachment:
+    """
+    A file to send as an attachment, created by AttachmentStore.stage() (or Signalcli.stage_attachment())
+
+    Attributes
+        path            File that is given to signal-cli (the staged copy if the store has a staging directory)
+        filename        Original filename
+        size            Size in bytes
+        content_type    MIME type (from the original attachment or guessed from the filename)
+        digest          SHA-256 hex digest of the content
+    """
+
+    __slots__ = ('path', 'filename', 'size', 'content_type', 'digest')
+
+    def __str__(self):
+        return "Attachment (" + self.filename + ", " + self.content_type + ", " + str(self.size) + " bytes, sha256=" + self.digest[:12] + ")"
+
+    def __init__(self, path, filename, size, content_type, digest):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.content_type = content_type
+        self.digest = digest
+
+
+class AttachmentStore:
+    """
+    Content-addressed cache of attachments, with all file I/O done in a thread pool.
+
+    stage() hashes a file once and remembers it by (path, size, mtime), so staging the same
+    file again costs a stat() and no reads. With a staging directory the content is also copied
+    to <staging_dir>/<sha256>/<filename>, so identical content is stored once, the Attachment stays
+    valid when the original file changes, and the least recently used copies are removed when
+    the directory grows over max_bytes.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+
+
+    def __init__(self, staging_dir=None, max_bytes=256*1024*1024, max_entries=4096, workers=4):
+        """ Parameters:
+                staging_dir=<path>          Directory for the content-addressed copies (None = send the original files)
+                max_bytes=<n>               Max total size of the files in staging_dir
+                max_entries=<n>             Max number of attachments remembered
+                workers=<n>                 Number of threads doing the file I/O
+        """
+        self.staging_dir = os.path.abspath(staging_dir) if staging_dir else None
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.workers = workers
+        self.staged_bytes = 0
+        self.__executor = None
+        ## digest -> Attachment, least recently used first
+        self.__attachments = collections.OrderedDict()
+        ## (path, size, mtime_ns) -> digest, and the reverse to forget them on eviction
+        self.__sources = {}
+        self.__sources_of = {}
+        ## (path, size, mtime_ns) -> future of a stage() in progress
+        self.__staging = {}
+        ## digest -> future of the removal of its evicted copy
+        self.__removing = {}
+        ## digest -> number of queued/in flight requests using it, never evicted
+        self.__pinned = {}
+        if self.staging_dir:
+            os.makedirs(self.staging_dir, exist_ok=True)
+            self.__scan_staging_dir()
+
+
+    def __scan_staging_dir(self):
+        """ Adopt the copies left by a previous run, oldest first """
+        entries = []
+        for entry in os.scandir(self.staging_dir):
+            if not entry.is_dir():
+                ## partial copy of a previous run
+                os.unlink(entry.path)
+                continue
+            files = os.listdir(entry.path)
+            if len(files) != 1:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            path = os.path.join(entry.path, files[0])
+            st = os.stat(path)
+            entries.append((st.st_mtime, path, st.st_size, entry.name))
+        for mtime, path, size, digest in sorted(entries):
+            filename = os.path.basename(path)
+            self.__attachments[digest] = Attachment(path, filename, size, AttachmentStore.guess_type(filename), digest)
+            self.staged_bytes += size
+        self.__evict()
+
+
+    @staticmethod
+    def guess_type(filename):
+        return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+    def __get_executor(self):
+        if self.__executor is None:
+            self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="signalcli-attachments")
+        return self.__executor
+
+
+    async def __run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.__get_executor(), function, *args)
+
+
+    def __move_into_place(self, tmp_path, digest, filename):
+        """ Move a finished copy to <staging_dir>/<digest>/<filename>, or drop it if that content is already staged """
+        digest_dir = os.path.join(self.staging_dir, digest)
+        removing = self.__removing.get(digest)
+        if removing:
+            ## the same content was evicted, its directory is being removed
+            removing.result()
+        try:
+            os.mkdir(digest_dir)
+        except FileExistsError:
+            os.unlink(tmp_path)
+            return os.path.join(digest_dir, os.listdir(digest_dir)[0])
+        staged_path = os.path.join(digest_dir, filename)
+        os.replace(tmp_path, staged_path)
+        return staged_path
+
+
+    def __hash_file(self, path, filename):
+        """ (digest, staged path) of a file, copies it to the staging directory while hashing if there is one """
+        sha = hashlib.sha256()
+        tmp_path = None
+        out = None
+        if self.staging_dir:
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.staging_dir)
+            out = os.fdopen(fd, 'wb')
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(AttachmentStore.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    if out:
+                        out.write(chunk)
+        except BaseException:
+            if out:
+                out.close()
+                os.unlink(tmp_path)
+            raise
+        digest = sha.hexdigest()
+        if not out:
+            return digest, path
+        out.close()
+        return digest, self.__move_into_place(tmp_path, digest, filename)
+
+
+    def __write_bytes(self, data, filename):
+        digest = hashlib.sha256(data).hexdigest()
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.staging_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return digest, self.__move_into_place(tmp_path, digest, filename)
+
+
+    def __add(self, attachment, source=None):
+        self.__attachments[attachment.digest] = attachment
+        if self.staging_dir:
+            self.staged_bytes += attachment.size
+        if source:
+            self.__sources[source] = attachment.digest
+            self.__sources_of.setdefault(attachment.digest, []).append(source)
+        self.__evict()
+        return attachment
+
+
+    def __evict(self):
+        for digest in [digest for digest, removing in self.__removing.items() if removing.done()]:
+            del self.__removing[digest]
+        if not self.__over_limits():
+            return
+        ## least recently used first, pinned ones are skipped and evicted once they're unpinned
+        for digest in list(self.__attachments):
+            if len(self.__attachments) <= 1 or not self.__over_limits():
+                break
+            if digest in self.__pinned:
+                continue
+            attachment = self.__attachments.pop(digest)
+            for source in self.__sources_of.pop(digest, []):
+                self.__sources.pop(source, None)
+            if self.staging_dir:
+                self.staged_bytes -= attachment.size
+                ## removed in the background, nobody waits for it
+                self.__removing[digest] = self.__get_executor().submit(shutil.rmtree, os.path.dirname(attachment.path), True)
+
+
+    def __over_limits(self):
+        return len(self.__attachments) > self.max_entries or (self.staging_dir and self.staged_bytes > self.max_bytes)
+
+
+    def pin(self, attachment):
+        """ Keep the staged copy of an attachment until unpin(), while a request using it is queued or in flight """
+        self.__pinned[attachment.digest] = self.__pinned.get(attachment.digest, 0) + 1
+
+
+    def unpin(self, attachment):
+        count = self.__pinned.pop(attachment.digest, 0) - 1
+        if count > 0:
+            self.__pinned[attachment.digest] = count
+        else:
+            self.__evict()
+
+
+    async def stage(self, path, content_type=None, filename=None):
+        """ Hash (and copy to the staging directory) a file, returns an Attachment that can be passed to send_message()
+
+            Parameters:
+                path                        File to stage, e.g. the storagePath of a received attachment
+                content_type                MIME type, guessed from the filename if not given
+                filename                    Original filename, defaults to the basename of path
+        """
+        path = os.path.abspath(path)
+        filename = os.path.basename(filename or path)
+        st = await self.__run(os.stat, path)
+        source = (path, st.st_size, st.st_mtime_ns)
+        digest = self.__sources.get(source)
+        if digest is not None:
+            self.__attachments.move_to_end(digest)
+            return self.__attachments[digest]
+        if source not in self.__staging:
+            self.__staging[source] = asyncio.ensure_future(self.__run(self.__hash_file, path, filename))
+            self.__staging[source].add_done_callback(lambda f: self.__staging.pop(source, None))
+        digest, staged_path = await asyncio.shield(self.__staging[source])
+        if digest in self.__attachments:
+            self.__attachments.move_to_end(digest)
+            if source not in self.__sources:
+                self.__sources[source] = digest
+                self.__sources_of.setdefault(digest, []).append(source)
+            return self.__attachments[digest]
+        return self.__add(Attachment(staged_path, filename, st.st_size, content_type or AttachmentStore.guess_type(filename), digest), source)
+
+
+    async def stage_bytes(self, data, filename, content_type=None):
+        """ Stage generated content (requires a staging directory), returns an Attachment """
+        if not self.staging_dir:
+            raise ValueError("stage_bytes() requires a staging directory")
+        digest, staged_path = await self.__run(self.__write_bytes, data, os.path.basename(filename))
+        if digest in self.__attachments:
+            self.__attachments.move_to_end(digest)
+            return self.__attachments[digest]
+        return self.__add(Attachment(staged_path, filename, len(data), content_type or AttachmentStore.guess_type(filename), digest))
+
+
+    def touch(self, attachment):
+        """ Mark an attachment as used, so its staged copy is not evicted before older ones """
+        if attachment.digest in self.__attachments:
+            self.__attachments.move_to_end(attachment.digest)
+
+
+    def get(self, digest):
+        """ Attachment with the given content digest, None if it's not in the cache """
+        return self.__attachments.get(digest)
+
+
+    def __len__(self):
+        return len(self.__attachments)
+
+
+    @staticmethod
+    def path_of(attachment):
+        """ File path of an Attachment, a received attachment dict (storagePath) or a path """
+        if isinstance(attachment, Attachment):
+            return attachment.path
+        if isinstance(attachment, dict):
+            return attachment['storagePath']
+        return attachment
+
+
+    @staticmethod
+    def __read_file(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+    async def read(self, attachment):
+        """ Content of an Attachment, received attachment dict or file, read in the thread pool """
+        return await self.__run(AttachmentStore.__read_file, AttachmentStore.path_of(attachment))
+
+
+    async def iter_chunks(self, attachment, chunk_size=None):
+        """ Async generator over the content of an Attachment, received attachment dict or file, for large files """
+        f = await self.__run(open, AttachmentStore.path_of(attachment), 'rb')
+        try:
+            while True:
+                chunk = await self.__run(f.read, chunk_size or AttachmentStore.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+
+    def close(self):
+        """ Stop the I/O threads, they're started again when needed """
+        if self.__executor:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
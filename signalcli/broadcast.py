@@ -0,0 +1,231 @@
+
+import json
+import time
+import asyncio
+import collections
+
+
+class BroadcastResult:
+    """
+    Outcome of sending a broadcast to one recipient
+
+    Attributes
+        recipient       Identity of the recipient (phone-number or groupId)
+        recipient_type  direct|group
+        success         Whether the message was sent
+        reqID           reqID of the successful attempt
+        attempts        Number of attempts
+        latency         Round trip time of the successful attempt in seconds
+        error           The exception of the last failed attempt (if not successful)
+    """
+
+    __slots__ = ('recipient', 'recipient_type', 'success', 'reqID', 'attempts', 'latency', 'error')
+
+    def __str__(self):
+        if self.success:
+            return "BroadcastResult (" + self.recipient + ": sent, reqID=" + str(self.reqID) + ", attempts=" + str(self.attempts) + ")"
+        return "BroadcastResult (" + self.recipient + ": failed, attempts=" + str(self.attempts) + ", error=" + repr(self.error) + ")"
+
+    def __init__(self, recipient, recipient_type, success, reqID=None, attempts=0, latency=None, error=None):
+        self.recipient = recipient
+        self.recipient_type = recipient_type
+        self.success = success
+        self.reqID = reqID
+        self.attempts = attempts
+        self.latency = latency
+        self.error = error
+
+
+class Broadcast:
+    """
+    A running broadcast of one message to many recipients, created with Signalcli.broadcast()
+
+    Results can be streamed with "async for result in job" (in completion order) or collected
+    with "await job.wait()". Progress is in job.stats(). The job can be stopped with cancel(), and
+    if a checkpoint file was given, starting the same broadcast again skips the recipients that
+    already got the message.
+    """
+
+    def __init__(self, sigcli_obj, recipients, message_body, attachments=[], concurrency=50, retries=2, retry_backoff=1.0,
+                 timeout=None, checkpoint_path=None):
+        self.sigcli_obj = sigcli_obj
+        self.message_body = message_body
+        self.attachments = attachments
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.checkpoint_path = checkpoint_path
+        self.results = []
+        self.unresolved = []
+        self.skipped = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.start_time = None
+        self.end_time = None
+        self.__results_queue = asyncio.Queue()
+        self.__checkpoint_file = None
+        self.__task = None
+        self.__todo = collections.deque(self.__resolve(recipients))
+        self.total = len(self.__todo)
+
+
+    def __resolve(self, recipients):
+        """ Deduplicate the recipients and resolve them to (identity, recipient_type) """
+        done = self.__read_checkpoint()
+        seen = set()
+        resolved = []
+        for recipient in recipients:
+            identity = getattr(recipient, 'identity', recipient)
+            if identity in seen:
+                continue
+            seen.add(identity)
+            if identity in done:
+                self.skipped += 1
+                continue
+            if identity in self.sigcli_obj.group_list:
+                resolved.append((identity, "group"))
+            elif identity in self.sigcli_obj.contact_list or identity.startswith("+"):
+                resolved.append((identity, "direct"))
+            else:
+                self.unresolved.append(identity)
+        return resolved
+
+
+    def __read_checkpoint(self):
+        done = set()
+        if not self.checkpoint_path:
+            return done
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('ok'):
+                        done.add(record['recipient'])
+        except FileNotFoundError:
+            pass
+        return done
+
+
+    def start(self):
+        if self.__task:
+            return
+        if self.checkpoint_path:
+            self.__checkpoint_file = open(self.checkpoint_path, 'a')
+        for identity in self.unresolved:
+            self.__finish(BroadcastResult(identity, None, False, error=LookupError("'" + identity + "' is neither a known group nor a phone-number")))
+        self.start_time = time.monotonic()
+        self.__task = self.sigcli_obj.get_event_loop().create_task(self.__run())
+
+
+    async def __run(self):
+        workers = [asyncio.ensure_future(self.__worker()) for i in range(min(self.concurrency, len(self.__todo)) or 1)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.end_time = time.monotonic()
+            if self.__checkpoint_file:
+                self.__checkpoint_file.close()
+                self.__checkpoint_file = None
+            self.__results_queue.put_nowait(None)
+
+
+    async def __worker(self):
+        while self.__todo:
+            identity, recipient_type = self.__todo.popleft()
+            self.__finish(await self.__send(identity, recipient_type))
+
+
+    async def __send(self, identity, recipient_type):
+        sig = self.sigcli_obj
+        error = None
+        for attempt in range(1, self.retries + 2):
+            try:
+                future = await sig.send_message_async(identity, self.message_body, recipient_type=recipient_type,
+                    attachments=self.attachments, timeout=self.timeout)
+                result = await future
+                return BroadcastResult(identity, recipient_type, True, reqID=result.reqID, attempts=attempt, latency=result.latency)
+            except sig.SignalcliTimeoutError as e:
+                error = e
+                if e.written:
+                    ## signal-cli may still send it, sending it again could deliver the message twice
+                    break
+            except sig.SignalcliSendError as e:
+                ## reported by signal-cli, or signal-cli was stopped, sending again won't help
+                error = e
+                break
+            if attempt <= self.retries:
+                await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1))
+        return BroadcastResult(identity, recipient_type, False, attempts=attempt, error=error)
+
+
+    def __finish(self, result):
+        self.results.append(result)
+        if result.success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        if self.__checkpoint_file:
+            self.__checkpoint_file.write(json.dumps({ 'recipient': result.recipient, 'ok': result.success }) + "\n")
+            self.__checkpoint_file.flush()
+        self.__results_queue.put_nowait(result)
+
+
+    def done(self):
+        return self.__task is not None and self.__task.done()
+
+
+    def cancel(self):
+        """ Stop the broadcast, the messages already in flight may still be sent """
+        if self.__task:
+            self.__task.cancel()
+
+
+    async def wait(self):
+        """ Wait until the broadcast is finished (or cancelled), returns the list of BroadcastResult objects """
+        try:
+            await asyncio.shield(self.__task)
+        except asyncio.CancelledError:
+            if not self.__task.cancelled():
+                raise
+        return self.results
+
+
+    def __await__(self):
+        return self.wait().__await__()
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        result = await self.__results_queue.get()
+        if result is None:
+            self.__results_queue.put_nowait(None)
+            raise StopAsyncIteration
+        return result
+
+
+    def stats(self):
+        """ Dict with the progress: total, done, succeeded, failed, skipped (from checkpoint), remaining, elapsed and sends_per_sec """
+        if self.start_time is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.end_time or time.monotonic()) - self.start_time
+        finished = self.succeeded + self.failed
+        return {
+            'total': self.total + len(self.unresolved),
+            'done': finished,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'remaining': self.total + len(self.unresolved) - finished,
+            'elapsed': elapsed,
+            'sends_per_sec': self.succeeded / elapsed if elapsed > 0 else 0.0,
+        }
@@ -0,0 +1,80 @@
+
+import os
+import json
+import sqlite3
+import concurrent.futures
+
+
+class DirectoryCache:
+    """
+    Persistent SQLite cache of the raw list_contacts/list_groups entries of one account.
+
+    The cache is loaded when the Signalcli object is created, so contacts and groups resolve
+    before signal-cli has answered the list requests, and afterwards only the changed entries
+    are written back. All writes are done from a single background thread.
+    """
+
+    def __init__(self, path):
+        """ Open (or create) the cache database at path """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="signalcli-cache")
+        self.__db = self.executor.submit(self.__open).result()
+
+
+    @staticmethod
+    def path_for(cache_dir, user_name):
+        """ Path of the cache database of user_name in cache_dir """
+        return os.path.join(cache_dir, user_name.replace(os.sep, "_") + ".sqlite")
+
+
+    def __open(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS contacts (identity TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS groups (identity TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+        db.commit()
+        return db
+
+
+    def __load(self):
+        contacts = [json.loads(row[0]) for row in self.__db.execute("SELECT entry FROM contacts")]
+        groups = [json.loads(row[0]) for row in self.__db.execute("SELECT entry FROM groups")]
+        return contacts, groups
+
+
+    def load(self):
+        """ Returns (contact_entries, group_entries) as stored in the cache """
+        return self.executor.submit(self.__load).result()
+
+
+    def __store_changes(self, table, changes):
+        upserts = [(change.identity, json.dumps(change.new_entry)) for change in changes if change.new_entry is not None]
+        deletes = [(change.identity,) for change in changes if change.new_entry is None]
+        with self.__db:
+            if upserts:
+                self.__db.executemany("INSERT OR REPLACE INTO " + table + " (identity, entry) VALUES (?, ?)", upserts)
+            if deletes:
+                self.__db.executemany("DELETE FROM " + table + " WHERE identity = ?", deletes)
+
+
+    def store_contact_changes(self, changes):
+        """ Write DirectoryChange objects of contacts to the cache in the background, returns a concurrent.futures.Future """
+        return self.executor.submit(self.__store_changes, "contacts", changes)
+
+
+    def store_group_changes(self, changes):
+        """ Write DirectoryChange objects of groups to the cache in the background, returns a concurrent.futures.Future """
+        return self.executor.submit(self.__store_changes, "groups", changes)
+
+
+    def __close(self):
+        self.__db.close()
+
+
+    def close(self):
+        """ Wait for pending writes and close the database """
+        self.executor.submit(self.__close).result()
+        self.executor.shutdown()
@@ -0,0 +1,96 @@
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+## the shared object handed to the worker for every alive response, see JsonCodec.is_alive_frame()
+ALIVE_RESPONSE = { 'respType': 'alive' }
+
+## the alive request, pre-encoded
+ALIVE_REQUEST_FRAME = b'{"reqType":"alive"}\n'
+
+_alive_frame_re = re.compile(rb'\s*\{\s*"respType"\s*:\s*"alive"\s*[,}]')
+
+
+class JsonCodec:
+    """
+    Encodes/decodes the line-JSON protocol spoken with signal-cli. This is the stdlib json implementation,
+    use get_codec() to get the fastest available one.
+
+    Attributes
+        name            Name of the codec (json|orjson|msgspec)
+        DecodeError     Exception (or tuple of exceptions) raised by loads() on invalid input
+    """
+
+    name = "json"
+    DecodeError = (json.JSONDecodeError, UnicodeDecodeError)
+
+    def dumps(self, data_object):
+        """ Encode data_object to utf8 bytes (without trailing newline) """
+        return json.dumps(data_object, ensure_ascii=False).encode('utf8')
+
+    def loads(self, frame):
+        """ Decode utf8 bytes """
+        return json.loads(frame)
+
+    @staticmethod
+    def is_alive_frame(frame):
+        """ Cheap check whether frame is an alive response, so it can be handled without decoding it """
+        return len(frame) < 64 and _alive_frame_re.match(frame) is not None
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+    DecodeError = orjson.JSONDecodeError if orjson else ()
+
+    def dumps(self, data_object):
+        return orjson.dumps(data_object)
+
+    def loads(self, frame):
+        return orjson.loads(frame)
+
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+    DecodeError = msgspec.DecodeError if msgspec else ()
+
+    def __init__(self):
+        self.__encoder = msgspec.json.Encoder()
+        self.__decoder = msgspec.json.Decoder()
+
+    def dumps(self, data_object):
+        return self.__encoder.encode(data_object)
+
+    def loads(self, frame):
+        return self.__decoder.decode(frame)
+
+
+def get_codec(name=None):
+    """ Get a codec by name (json|orjson|msgspec), or the fastest installed one if name is None """
+    if name is None:
+        if orjson:
+            return OrjsonCodec()
+        if msgspec:
+            return MsgspecCodec()
+        return JsonCodec()
+    if name == "json":
+        return JsonCodec()
+    if name == "orjson":
+        if not orjson:
+            raise ImportError("json_codec 'orjson' requested but orjson is not installed")
+        return OrjsonCodec()
+    if name == "msgspec":
+        if not msgspec:
+            raise ImportError("json_codec 'msgspec' requested but msgspec is not installed")
+        return MsgspecCodec()
+    raise ValueError("unknown json_codec '" + str(name) + "'")
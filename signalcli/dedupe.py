@@ -0,0 +1,143 @@
+
+import os
+import collections
+import concurrent.futures
+
+from .codec import JsonCodec
+
+
+class EnvelopeDedupe:
+    """
+    Bounded index of the envelopes seen recently, to drop envelopes signal-cli delivers again
+    (e.g. after a reconnect or a restart).
+
+    Envelopes are identified by (source, sourceDevice, timestamp). The max_entries most recently
+    seen keys are kept in memory. With a path they're also appended to a file by flush() from a
+    single background thread, which is read back when the index is created so duplicates are
+    detected across restarts, and rewritten with only the live keys when it has grown to twice
+    max_entries.
+    """
+
+    def __init__(self, max_entries=10000, path=None, json_codec=None):
+        """ Parameters:
+                max_entries=<n>             Number of envelope keys remembered
+                path=<file>                 Persist the keys in this file (None = in memory only)
+                json_codec=<codec>          Codec object from signalcli.codec (defaults to stdlib json)
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.json_codec = json_codec or JsonCodec()
+        self.duplicates = 0
+        self.__keys = collections.OrderedDict()
+        self.__file = None
+        self.__executor = None
+        self.__records = 0
+        self.__unflushed = []
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.__read()
+            self.__compact(list(self.__keys))
+
+
+    @staticmethod
+    def path_for(dedupe_dir, user_name):
+        """ Path of the dedupe index of user_name in dedupe_dir """
+        return os.path.join(dedupe_dir, user_name.replace(os.sep, "_") + ".dedupe")
+
+
+    def __read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        key = tuple(self.json_codec.loads(line))
+                    except (self.json_codec.DecodeError, TypeError):
+                        ## torn write at the end of the file
+                        continue
+                    self.__remember(key)
+        except FileNotFoundError:
+            pass
+
+
+    def __compact(self, keys):
+        if self.__file:
+            self.__file.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b"".join(self.json_codec.dumps(list(key)) + b"\n" for key in keys))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.__file = open(self.path, 'ab')
+
+
+    def __write(self, keys):
+        if not self.__file:
+            self.__file = open(self.path, 'ab')
+        self.__file.write(b"".join(self.json_codec.dumps(list(key)) + b"\n" for key in keys))
+        self.__file.flush()
+
+
+    def __remember(self, key):
+        self.__keys[key] = None
+        if len(self.__keys) > self.max_entries:
+            self.__keys.popitem(last=False)
+
+
+    def is_duplicate(self, envelope):
+        """ Check an envelope and remember it, returns True if it has been seen before """
+        key = (envelope['source'], envelope['sourceDevice'], envelope['timestamp'])
+        if key in self.__keys:
+            self.__keys.move_to_end(key)
+            self.duplicates += 1
+            return True
+        self.__remember(key)
+        if self.path:
+            self.__unflushed.append(key)
+        return False
+
+
+    def __get_executor(self):
+        if self.__executor is None:
+            self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="signalcli-dedupe")
+        return self.__executor
+
+
+    def flush(self):
+        """ Write the keys remembered since the last flush to the file in the background, called after every batch of frames
+
+            Return:
+                concurrent.futures.Future, or None if there was nothing to write
+        """
+        if not self.__unflushed:
+            return None
+        keys = self.__unflushed
+        self.__unflushed = []
+        self.__records += len(keys)
+        write_future = self.__get_executor().submit(self.__write, keys)
+        if self.__records >= 2 * self.max_entries:
+            ## the background thread runs in order, the keys above are written first
+            self.__get_executor().submit(self.__compact, list(self.__keys))
+            self.__records = len(self.__keys)
+        return write_future
+
+
+    def __len__(self):
+        return len(self.__keys)
+
+
+    def __close(self):
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+
+    def close(self):
+        """ Flush and close the file, it's opened again if more envelopes are checked """
+        self.flush()
+        if self.__executor:
+            self.__executor.submit(self.__close).result()
+            self.__executor.shutdown()
+            self.__executor = None
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Fake signal-cli "jsonEventLoop" for testing and benchmarking without a registered Signal account.
+
+Speaks the same line-JSON protocol on stdin/stdout as the signal-cli fork: sends the metadata
+frame on startup, answers alive, list_contacts, list_groups and send_message requests, and
+generates incoming envelopes at a configurable rate once the contacts/groups handshake is done.
+
+Use it through bin_path, options are read from the command line and from the
+SIGNALCLI_FAKE_OPTS environment variable (since Signalcli only passes "-u <user> jsonEventLoop"):
+
+    os.environ['SIGNALCLI_FAKE_OPTS'] = "--envelopes 10000 --envelope-rate 0 --groups 2000"
+    sig = signalcli.Signalcli(user_name="+46123456789", bin_path=signalcli.fake_signal_cli.PATH)
+
+The body of every generated message is "<text> <epoch-seconds-when-sent> <padding>",
+which the benchmarks use to measure end-to-end latency.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import argparse
+import threading
+
+
+## path of this script, to be used as bin_path
+PATH = os.path.abspath(__file__)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Fake signal-cli jsonEventLoop")
+    parser.add_argument("-u", "--username", default="+10000000000")
+    parser.add_argument("command", nargs="?", default="jsonEventLoop")
+    parser.add_argument("--envelopes", type=int, default=0, help="Number of incoming envelopes to generate (default 0)")
+    parser.add_argument("--envelope-rate", type=float, default=0, help="Envelopes per second, 0 = as fast as possible")
+    parser.add_argument("--payload-size", type=int, default=32, help="Approximate size of the message bodies in bytes")
+    parser.add_argument("--contacts", type=int, default=100, help="Number of contacts in list_contacts")
+    parser.add_argument("--groups", type=int, default=10, help="Number of groups in list_groups")
+    parser.add_argument("--group-size", type=int, default=20, help="Number of members per group")
+    parser.add_argument("--group-ratio", type=float, default=0.5, help="Share of envelopes sent to groups")
+    parser.add_argument("--sync-ratio", type=float, default=0.0, help="Share of envelopes that are sent_message sync messages")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="Share of envelopes that are delivered twice")
+    parser.add_argument("--attachment-ratio", type=float, default=0.0, help="Share of envelopes with an attachment")
+    parser.add_argument("--command-text", default="hello", help="Text the message bodies start with")
+    parser.add_argument("--send-delay", type=float, default=0.0, help="Seconds before answering a send_message request")
+    parser.add_argument("--send-error-ratio", type=float, default=0.0, help="Share of send_message requests answered with an error")
+    parser.add_argument("--attachments-path", default="/tmp/signalcli-fake-attachments")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(shlex.split(os.environ.get("SIGNALCLI_FAKE_OPTS", "")) + argv)
+
+
+class FakeSignalcli:
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.write_lock = threading.Lock()
+        self.handshake_done = threading.Event()
+        self.contacts = ["+1%010d" % i for i in range(options.contacts)]
+        self.groups = ["group%06d" % i for i in range(options.groups)]
+        self.padding = "x" * max(0, options.payload_size - len(options.command_text) - 20)
+        self.last_timestamps = {}
+
+
+    def write(self, data_objects):
+        data = "".join(json.dumps(data_object) + "\n" for data_object in data_objects)
+        with self.write_lock:
+            try:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            except BrokenPipeError:
+                ## the library has gone away
+                os._exit(0)
+
+
+    def contact_entries(self):
+        return [{ "name": "Contact " + number, "number": number, "color": "blue", "profileKey": None, "blocked": False }
+            for number in self.contacts]
+
+
+    def group_entries(self):
+        members = self.contacts or ["+10000000000"]
+        return [{ "name": "Group " + group_id, "groupId": group_id, "color": "red", "blocked": False, "active": True,
+            "members": [members[(i + j) % len(members)] for j in range(self.options.group_size)] }
+            for i, group_id in enumerate(self.groups)]
+
+
+    def envelope(self, n):
+        options = self.options
+        rnd = self.random
+        sender = self.contacts[n % len(self.contacts)] if self.contacts else "+10000000000"
+        content = {
+            "message": options.command_text + " " + repr(time.time()) + " " + self.padding,
+            "attachments": [],
+            "groupInfo": None
+        }
+        if self.groups and rnd.random() < options.group_ratio:
+            content["groupInfo"] = { "groupId": self.groups[n % len(self.groups)] }
+        if rnd.random() < options.attachment_ratio:
+            content["attachments"].append({ "id": "att%d" % n, "filename": "image%d.jpg" % n, "contentType": "image/jpeg", "size": 12345 })
+        ## like real envelopes, the timestamps of a sender are unique (they identify the message)
+        timestamp = max(int(time.time() * 1000), self.last_timestamps.get(sender, 0) + 1)
+        self.last_timestamps[sender] = timestamp
+        envelope = { "source": sender, "sourceDevice": 1, "timestamp": timestamp, "dataMessage": None, "syncMessage": None }
+        if rnd.random() < options.sync_ratio:
+            envelope["source"] = options.username
+            if not content["groupInfo"]:
+                content["destination"] = sender
+            envelope["syncMessage"] = { "sentMessage": content }
+        else:
+            envelope["dataMessage"] = content
+        return { "respType": "envelope", "envelope": envelope }
+
+
+    def generate_envelopes(self):
+        options = self.options
+        self.handshake_done.wait()
+        start = time.time()
+        n = 0
+        while n < options.envelopes:
+            if options.envelope_rate > 0:
+                ## write whatever is due, in one batch
+                due = min(options.envelopes, int((time.time() - start) * options.envelope_rate) + 1)
+                if due <= n:
+                    time.sleep(min(0.01, 1.0 / options.envelope_rate))
+                    continue
+            else:
+                due = min(options.envelopes, n + 100)
+            envelopes = []
+            for i in range(n, due):
+                envelopes.append(self.envelope(i))
+                if self.random.random() < options.duplicate_ratio:
+                    envelopes.append(envelopes[-1])
+            self.write(envelopes)
+            n = due
+
+
+    def answer(self, req):
+        options = self.options
+        req_type = req.get("reqType")
+        if req_type == "alive":
+            return { "respType": "alive" }
+        elif req_type == "list_contacts":
+            return { "respType": "list_contacts", "data": self.contact_entries() }
+        elif req_type == "list_groups":
+            self.handshake_done.set()
+            return { "respType": "list_groups", "data": self.group_entries() }
+        elif req_type == "send_message":
+            if options.send_delay:
+                time.sleep(options.send_delay)
+            response = { "respType": "send_message", "reqID": req.get("reqID"), "timestamp": int(time.time() * 1000) }
+            if self.random.random() < options.send_error_ratio:
+                response["error"] = "fake send error"
+            return response
+        return { "respType": "error", "reqID": req.get("reqID"), "error": "unknown reqType '" + str(req_type) + "'" }
+
+
+    def run(self):
+        self.write([{ "respType": "metadata", "apiVer": 2, "attachmentsPath": self.options.attachments_path }])
+        threading.Thread(target=self.generate_envelopes, daemon=True).start()
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                req = json.loads(line)
+            except ValueError:
+                print("fake signal-cli: invalid request: " + line.strip(), file=sys.stderr)
+                continue
+            self.write([self.answer(req)])
+
+
+def main(argv=None):
+    FakeSignalcli(parse_args(sys.argv[1:] if argv is None else argv)).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+
+import os
+import time
+import asyncio
+import sqlite3
+import concurrent.futures
+
+from .codec import JsonCodec
+
+
+class HistoryStore:
+    """
+    SQLite store of the received (and synced sent) messages of one account.
+
+    Messages are added from the event loop with add() and written in batches by flush() from a
+    single background thread, which also runs the queries, so neither blocks the event loop.
+    Messages are indexed by conversation, sender and timestamp, and the raw envelopes are
+    kept so queries return the same Message objects the callbacks get.
+    """
+
+    ## seconds between deletions of messages older than the retention period
+    PRUNE_INTERVAL = 60.0
+
+
+    def __init__(self, path, retention=None, json_codec=None):
+        """ Open (or create) the history database at path
+            Parameters:
+                path                        Database file
+                retention=<seconds>         Delete messages older than this (None = keep everything)
+                json_codec=<codec>          Codec object from signalcli.codec (defaults to stdlib json)
+        """
+        self.path = path
+        self.retention = retention
+        self.json_codec = json_codec or JsonCodec()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="signalcli-history")
+        self.__db = self.executor.submit(self.__open).result()
+        self.__rows = []
+        self.__last_prune = 0.0
+
+
+    @staticmethod
+    def path_for(history_dir, user_name):
+        """ Path of the history database of user_name in history_dir """
+        return os.path.join(history_dir, user_name.replace(os.sep, "_") + ".history.sqlite")
+
+
+    def __open(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            timestamp INTEGER NOT NULL, sender TEXT NOT NULL, sender_device INTEGER NOT NULL,
+            conversation TEXT NOT NULL, recipient_type TEXT NOT NULL, type TEXT NOT NULL,
+            envelope BLOB NOT NULL, PRIMARY KEY (sender, sender_device, timestamp))""")
+        db.execute("CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation, timestamp)")
+        db.execute("CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender, timestamp)")
+        db.execute("CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp)")
+        db.commit()
+        return db
+
+
+    def add(self, envelope, msg):
+        """ Queue a message for writing, msg is the Message/MessageView built from envelope """
+        self.__rows.append((msg.timestamp, msg.sender_identity, msg.sender_device, msg.conversation_identity,
+            msg.recipient_type, msg.type, envelope))
+
+
+    def __write(self, rows, prune_before):
+        dumps = self.json_codec.dumps
+        with self.__db:
+            self.__db.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [row[:6] + (dumps(row[6]),) for row in rows])
+            if prune_before is not None:
+                self.__db.execute("DELETE FROM messages WHERE timestamp < ?", (prune_before,))
+
+
+    def flush(self):
+        """ Write the queued messages in the background (and prune old ones), called after every batch of frames
+
+            Return:
+                concurrent.futures.Future, or None if there was nothing to do
+        """
+        prune_before = None
+        if self.retention is not None and time.monotonic() - self.__last_prune >= HistoryStore.PRUNE_INTERVAL:
+            self.__last_prune = time.monotonic()
+            prune_before = int((time.time() - self.retention) * 1000)
+        if not self.__rows and prune_before is None:
+            return None
+        rows = self.__rows
+        self.__rows = []
+        return self.executor.submit(self.__write, rows, prune_before)
+
+
+    def __query(self, conversation, sender, since, until, limit):
+        where = []
+        args = []
+        if conversation is not None:
+            where.append("conversation = ?")
+            args.append(conversation)
+        if sender is not None:
+            where.append("sender = ?")
+            args.append(sender)
+        if since is not None:
+            where.append("timestamp >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("timestamp < ?")
+            args.append(until)
+        sql = "SELECT envelope FROM messages"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        ## the newest ones are selected, and returned oldest first
+        sql += " ORDER BY timestamp DESC"
+        if limit:
+            sql += " LIMIT ?"
+            args.append(limit)
+        loads = self.json_codec.loads
+        envelopes = [loads(row[0]) for row in self.__db.execute(sql, args)]
+        envelopes.reverse()
+        return envelopes
+
+
+    async def query(self, conversation=None, sender=None, since=None, until=None, limit=50):
+        """ Raw envelopes of the last <limit> messages matching all the given conditions, oldest first
+
+            Parameters:
+                conversation                conversation_identity of the messages (groupId or the other party's phone-number)
+                sender                      sender_identity of the messages
+                since/until                 Timestamp range in epoch ms (since inclusive, until exclusive)
+                limit                       Max number of messages (0/None = all)
+        """
+        ## messages queued before the query are written first, the executor runs in order
+        self.flush()
+        return await asyncio.wrap_future(self.executor.submit(self.__query, conversation, sender, since, until, limit))
+
+
+    def __count(self):
+        return self.__db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+    async def count(self):
+        """ Number of stored messages """
+        self.flush()
+        return await asyncio.wrap_future(self.executor.submit(self.__count))
+
+
+    def __close(self):
+        self.__db.close()
+
+
+    def close(self):
+        """ Write the queued messages and close the database """
+        self.flush()
+        self.executor.submit(self.__close).result()
+        self.executor.shutdown()
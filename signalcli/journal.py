@@ -0,0 +1,139 @@
+
+import os
+import concurrent.futures
+
+from .codec import JsonCodec
+
+
+class OutboundJournal:
+    """
+    Append-only on-disk journal of outgoing send_message requests that have not been answered yet.
+
+    Every request is appended when it's queued and a "done" record is appended when signal-cli
+    has answered it, so after a crash the unanswered requests can be read back with load() and
+    sent again. Records are collected on the event loop and written by flush() from a single
+    background thread. The file is compacted when most of it is done records.
+    """
+
+    ## compact the file when at least this many requests are done and they're more than half of the records
+    COMPACT_THRESHOLD = 1000
+
+
+    def __init__(self, path, json_codec=None, fsync=False):
+        """ Open (or create) the journal at path
+            Parameters:
+                path                        Journal file
+                json_codec=<codec>          Codec object from signalcli.codec (defaults to stdlib json)
+                fsync=(True/False)          fsync() after every write, survives power loss at the cost of write latency
+        """
+        self.path = path
+        self.json_codec = json_codec or JsonCodec()
+        self.fsync = fsync
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__unanswered = self.__read()
+        self.__done_count = 0
+        self.__records = []
+        self.__file = None
+        self.__compact(list(self.__unanswered.values()))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="signalcli-journal")
+
+
+    @staticmethod
+    def path_for(journal_dir, user_name):
+        """ Path of the journal of user_name in journal_dir """
+        return os.path.join(journal_dir, user_name.replace(os.sep, "_") + ".journal")
+
+
+    def __read(self):
+        unanswered = {}
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = self.json_codec.loads(line)
+                    except self.json_codec.DecodeError:
+                        ## torn write at the end of the file
+                        continue
+                    if 'req' in record:
+                        unanswered[record['req']['reqID']] = record['req']
+                    else:
+                        unanswered.pop(record.get('done'), None)
+        except FileNotFoundError:
+            pass
+        return unanswered
+
+
+    def __compact(self, reqs):
+        if self.__file:
+            self.__file.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            for req in reqs:
+                f.write(self.json_codec.dumps({ 'req': req }) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.__file = open(self.path, 'ab')
+
+
+    def __write(self, records):
+        self.__file.write(b"".join(self.json_codec.dumps(record) + b"\n" for record in records))
+        self.__file.flush()
+        if self.fsync:
+            os.fsync(self.__file.fileno())
+
+
+    def load(self):
+        """ List of the unanswered requests found in the journal when it was opened, in reqID order """
+        return [self.__unanswered[reqID] for reqID in sorted(self.__unanswered)]
+
+
+    def max_reqID(self):
+        """ Highest reqID of the unanswered requests, 0 if there are none """
+        return max(self.__unanswered, default=0)
+
+
+    def record_requests(self, reqs):
+        """ Add requests that are about to be sent, written by the next flush() """
+        for req in reqs:
+            self.__unanswered[req['reqID']] = req
+            self.__records.append({ 'req': req })
+
+
+    def record_done(self, reqID):
+        """ Mark a request as answered, it won't be replayed """
+        if self.__unanswered.pop(reqID, None) is None:
+            return
+        self.__records.append({ 'done': reqID })
+        self.__done_count += 1
+        if self.__done_count >= OutboundJournal.COMPACT_THRESHOLD and self.__done_count > len(self.__unanswered):
+            ## the records collected so far are written first, the background thread runs in order
+            self.flush()
+            self.executor.submit(self.__compact, list(self.__unanswered.values()))
+            self.__done_count = 0
+
+
+    def flush(self):
+        """ Write the collected records in the background, called once per batch of requests/responses
+
+            Return:
+                concurrent.futures.Future, or None if there was nothing to write
+        """
+        if not self.__records:
+            return None
+        records = self.__records
+        self.__records = []
+        return self.executor.submit(self.__write, records)
+
+
+    def __close(self):
+        self.__file.close()
+
+
+    def close(self):
+        """ Write the collected records and close the file """
+        self.flush()
+        self.executor.submit(self.__close).result()
+        self.executor.shutdown()
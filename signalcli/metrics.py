@@ -0,0 +1,193 @@
+
+import asyncio
+import bisect
+
+
+class Histogram:
+    """
+    Histogram with fixed bucket upper bounds, Prometheus style (cumulative when exported)
+
+    Attributes
+        buckets         Bucket upper bounds
+        counts          Number of observations per bucket (not cumulative), the last one is +Inf
+        count           Total number of observations
+        sum             Sum of the observed values
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Estimated quantile (upper bound of the bucket the quantile falls in) """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of one or more Signalcli objects.
+
+    Series are identified by a metric name and a tuple of (label, value) pairs. Read them with
+    snapshot() (pull API) or prometheus_text(), or serve them over HTTP with start_http_server().
+    A Metrics object can be shared by several Signalcli objects (e.g. all accounts of a SignalcliPool),
+    every series gets an 'account' label.
+    """
+
+    ## seconds, from 50us to 60s
+    DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    HELP = {
+        'signalcli_frames_total': ('counter', "Frames received from signal-cli, by respType"),
+        'signalcli_frame_bytes_total': ('counter', "Bytes of frames received from signal-cli"),
+        'signalcli_duplicate_envelopes_total': ('counter', "Envelopes dropped because they had been received before"),
+        'signalcli_json_decode_seconds': ('histogram', "Time spent decoding one chunk of frames from signal-cli"),
+        'signalcli_callback_seconds': ('histogram', "Duration of event callbacks, by event and handler"),
+        'signalcli_callback_errors_total': ('counter', "Exceptions raised by event callbacks, by event and handler"),
+        'signalcli_request_seconds': ('histogram', "Time from queueing a send_message request until its response"),
+        'signalcli_request_errors_total': ('counter', "send_message requests that failed, by reason"),
+        'signalcli_requests_written_total': ('counter', "Requests written to signal-cli"),
+        'signalcli_coalesced_replies_total': ('counter', "Replies merged into another reply's request"),
+        'signalcli_alive_rtt_seconds': ('histogram', "Round trip time of alive pings"),
+        'signalcli_incoming_queue_depth': ('gauge', "Batches of frames waiting in incoming_json_queue"),
+        'signalcli_outgoing_queue_depth': ('gauge', "Requests not written to signal-cli yet, queued or held back by the rate limits"),
+        'signalcli_pending_requests': ('gauge', "Requests waiting for a response from signal-cli"),
+        'signalcli_active_conversations': ('gauge', "Conversations with events waiting for callbacks"),
+    }
+
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets) if buckets else Metrics.DEFAULT_BUCKETS
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.__server = None
+        self.__server_lock = None
+        self.__server_users = 0
+
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+
+    def set_gauge(self, name, labels, value_function):
+        """ Register a gauge, value_function() is called when the metrics are read """
+        self.gauges[(name, labels)] = value_function
+
+
+    def remove_gauges(self, labels):
+        """ Remove the gauges whose labels include all of labels """
+        label_set = set(labels)
+        for key in [key for key in self.gauges if label_set.issubset(key[1])]:
+            del self.gauges[key]
+
+
+    def snapshot(self):
+        """ Dict of the current values: {name: [{'labels': {...}, 'value'|'count'/'sum'/'p50'/'p90'/'p99': ...}, ...]} """
+        result = {}
+        for (name, labels), value in self.counters.items():
+            result.setdefault(name, []).append({ 'labels': dict(labels), 'value': value })
+        for (name, labels), value_function in self.gauges.items():
+            result.setdefault(name, []).append({ 'labels': dict(labels), 'value': value_function() })
+        for (name, labels), histogram in self.histograms.items():
+            result.setdefault(name, []).append({ 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                'p50': histogram.quantile(0.5), 'p90': histogram.quantile(0.9), 'p99': histogram.quantile(0.99) })
+        return result
+
+
+    @staticmethod
+    def __format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in pairs) + "}"
+
+
+    def prometheus_text(self):
+        """ The metrics in Prometheus text exposition format """
+        series = {}
+        for (name, labels), value in self.counters.items():
+            series.setdefault(name, []).append(name + Metrics.__format_labels(labels) + " " + str(value))
+        for (name, labels), value_function in self.gauges.items():
+            series.setdefault(name, []).append(name + Metrics.__format_labels(labels) + " " + str(value_function()))
+        for (name, labels), histogram in self.histograms.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                cumulative += n
+                lines.append(name + "_bucket" + Metrics.__format_labels(labels, [("le", bound)]) + " " + str(cumulative))
+            lines.append(name + "_sum" + Metrics.__format_labels(labels) + " " + repr(histogram.sum))
+            lines.append(name + "_count" + Metrics.__format_labels(labels) + " " + str(histogram.count))
+        out = []
+        for name in sorted(series):
+            metric_type, help_text = Metrics.HELP.get(name, ('untyped', name))
+            out.append("# HELP " + name + " " + help_text)
+            out.append("# TYPE " + name + " " + metric_type)
+            out.extend(series[name])
+        return "\n".join(out) + "\n"
+
+
+    async def __handle_http(self, reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = self.prometheus_text().encode('utf8')
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def start_http_server(self, port, host="127.0.0.1"):
+        """ Serve prometheus_text() over HTTP on host:port (any path)
+
+            The server is shared: when it's already running (e.g. started by another account) it's reused,
+            and every call has to be matched by a stop_http_server() call, the last one closes it.
+        """
+        if not self.__server_lock:
+            ## created lazily so it belongs to the running event loop
+            self.__server_lock = asyncio.Lock()
+        async with self.__server_lock:
+            if not self.__server:
+                self.__server = await asyncio.start_server(self.__handle_http, host, port)
+            self.__server_users += 1
+        return self.__server
+
+
+    async def stop_http_server(self):
+        """ Release the server taken with start_http_server(), it's closed when nobody uses it anymore """
+        if not self.__server_users:
+            return
+        self.__server_users -= 1
+        if self.__server_users or not self.__server:
+            return
+        server = self.__server
+        self.__server = None
+        server.close()
+        await server.wait_closed()
@@ -0,0 +1,176 @@
+
+import asyncio
+import concurrent.futures
+
+from .signalcli import Signalcli
+
+
+class SignalcliPool:
+    """
+    Runs many signal-cli accounts (one jsonEventLoop subprocess each) from a single asyncio event loop.
+
+    Callbacks registered with on() are attached to every account, including accounts added later,
+    and are called with the Signalcli object of the account that received the event
+    (messages also carry the receiving account in msg.account), so sigcli_obj.reply() always
+    answers through the right subprocess.
+    """
+
+    class SignalcliPoolError(Exception):
+        pass
+
+
+    def __init__(self, event_loop=None, bin_path="signal-cli", callback_workers=0, **signalcli_kwargs):
+        """ Create new SignalcliPool object
+            Parameters:
+                event_loop=<evtloop>        Provide custom asyncio eventloop (otherwise will retrieve standard eventloop)
+                bin_path=<path>             Full path to signal-cli executable
+                callback_workers=<n>        Size of the thread pool for plain callbacks, shared by all accounts (0 = run them in the event loop)
+                **signalcli_kwargs          Default keyword arguments for every Signalcli object (debug, alive_check, send_timeout, ...)
+        """
+        if not event_loop:
+            self.async_loop = asyncio.get_event_loop()
+        else:
+            self.async_loop = event_loop
+        self.bin_path = bin_path
+        self.signalcli_kwargs = signalcli_kwargs
+        if callback_workers:
+            self.callback_executor = concurrent.futures.ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="signalcli-callback")
+        else:
+            self.callback_executor = None
+        self.accounts = {}
+        self.callbacks = []
+
+
+    def __subscribe(self, sig, pool_record):
+        if pool_record['route_filters'] is not None:
+            account_record = sig.route(pool_record['callback'], *pool_record['callback_data'],
+                run_in_executor=pool_record['run_in_executor'], **pool_record['route_filters'])
+        else:
+            account_record = sig.on(pool_record['event_name'], pool_record['callback'],
+                *pool_record['callback_data'], run_in_executor=pool_record['run_in_executor'])
+        pool_record['account_records'][sig.user_name] = account_record
+
+
+    def __add_pool_record(self, pool_record):
+        for sig in self.accounts.values():
+            self.__subscribe(sig, pool_record)
+        self.callbacks.append(pool_record)
+        return pool_record
+
+
+    async def add_account(self, user_name, **kwargs):
+        """ Start a new account, kwargs override the pool defaults for this account. Returns the Signalcli object """
+        if user_name in self.accounts:
+            raise SignalcliPool.SignalcliPoolError("account '" + user_name + "' is already running")
+        options = dict(self.signalcli_kwargs)
+        options.update(kwargs)
+        options.setdefault('bin_path', self.bin_path)
+        sig = Signalcli(user_name=user_name, event_loop=self.async_loop, callback_executor=self.callback_executor,
+            autostart=False, exit_on_eof=False, **options)
+        for pool_record in self.callbacks:
+            self.__subscribe(sig, pool_record)
+        self.accounts[user_name] = sig
+        try:
+            await sig.start()
+        except BaseException:
+            del self.accounts[user_name]
+            for pool_record in self.callbacks:
+                pool_record['account_records'].pop(user_name, None)
+            ## start() may have failed after spawning signal-cli
+            await sig.stop()
+            raise
+        return sig
+
+
+    async def remove_account(self, user_name):
+        """ Stop the account and remove it from the pool """
+        sig = self.accounts.pop(user_name, None)
+        if not sig:
+            raise SignalcliPool.SignalcliPoolError("no such account '" + user_name + "'")
+        for pool_record in self.callbacks:
+            pool_record['account_records'].pop(user_name, None)
+        await sig.stop()
+
+
+    async def start(self, user_names):
+        """ Start several accounts concurrently, returns the list of Signalcli objects.
+            If any of them fails to start, the ones that did start are stopped again and the first error is raised """
+        results = await asyncio.gather(*[self.add_account(user_name) for user_name in user_names], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await asyncio.gather(*[self.remove_account(sig.user_name) for sig in results
+                if isinstance(sig, Signalcli) and self.accounts.get(sig.user_name) is sig])
+            raise errors[0]
+        return results
+
+
+    async def stop(self):
+        """ Stop all accounts """
+        await asyncio.gather(*[self.remove_account(user_name) for user_name in list(self.accounts)])
+        if self.callback_executor:
+            self.callback_executor.shutdown(wait=False)
+
+
+    def get_account(self, user_name):
+        """ Get the Signalcli object of an account """
+        try:
+            return self.accounts[user_name]
+        except KeyError:
+            raise SignalcliPool.SignalcliPoolError("no such account '" + user_name + "'")
+
+
+    def send_message(self, account, recipient_identity, message_body, recipient_type="direct", attachments = [], timeout=None):
+        """ Send a message through the given account, see Signalcli.send_message() """
+        return self.get_account(account).send_message(recipient_identity, message_body, recipient_type=recipient_type,
+            attachments=attachments, timeout=timeout)
+
+
+    def broadcast(self, account, recipients, message_body, **kwargs):
+        """ Send a message to many recipients through the given account, see Signalcli.broadcast() """
+        return self.get_account(account).broadcast(recipients, message_body, **kwargs)
+
+
+    def reply(self, original_message, message_body, **kwargs):
+        """ Reply to a message through the account that received it, see Signalcli.reply() """
+        return self.get_account(original_message.account).reply(original_message, message_body, **kwargs)
+
+
+    def on(self, event_name, callback, *callback_data, run_in_executor=None):
+        """ Add event subscriber callback on all accounts (current and future), see Signalcli.on()
+
+            Return:
+                callback_record object that can later be used to remove the callback.
+        """
+        return self.__add_pool_record({ 'event_name': event_name, 'callback': callback, 'callback_data': callback_data,
+            'run_in_executor': run_in_executor, 'route_filters': None, 'account_records': {} })
+
+
+    def route(self, callback, *callback_data, run_in_executor=None, **route_filters):
+        """ Add message route on all accounts (current and future), see Signalcli.route()
+
+            Return:
+                callback_record object that can later be used to remove the callback.
+        """
+        return self.__add_pool_record({ 'event_name': 'message', 'callback': callback, 'callback_data': callback_data,
+            'run_in_executor': run_in_executor, 'route_filters': route_filters, 'account_records': {} })
+
+
+    def remove_callback(self, callback_record):
+        """ Remove callback provided the callback_record as returned by the "on('event_name', cb)" call """
+        try:
+            self.callbacks.remove(callback_record)
+        except ValueError:
+            return
+        for user_name, account_record in callback_record['account_records'].items():
+            if user_name in self.accounts:
+                self.accounts[user_name].remove_callback(account_record)
+
+
+    def get_event_loop(self):
+        """ Get the asyncio event loop object, for creating custom tasks etc """
+        return self.async_loop
+
+
+    def run(self):
+        """ Starts the asyncio event loop with run_forever() """
+        self.async_loop.run_forever()
@@ -0,0 +1,143 @@
+
+class Router:
+    """
+    Compiled index of message routes, see Signalcli.route().
+
+    Every route is indexed on its most selective filter: commands in a prefix trie over the
+    message body, groups and senders in hash tables, routes without any of those in a plain list.
+    Matching a message walks the trie once and does two hash lookups, and only the resulting
+    candidates get their remaining (cheap equality) filters checked.
+    """
+
+    class Route:
+        """
+        A registered route
+
+        Attributes
+            order           Registration order, routes are called in this order
+            callback_record Callback record ({'callback':..., 'callback_data':..., ...}) to dispatch matches to
+            filters         Dict of filter name -> frozenset of accepted values
+        """
+
+        __slots__ = ('order', 'callback_record', 'filters')
+
+        def __init__(self, order, callback_record, filters):
+            self.order = order
+            self.callback_record = callback_record
+            self.filters = filters
+
+        def accepts(self, msg):
+            """ Check all filters that are not covered by the index the route was found through """
+            filters = self.filters
+            if 'message_type' in filters and msg.type not in filters['message_type']:
+                return False
+            if 'recipient_type' in filters and msg.recipient_type not in filters['recipient_type']:
+                return False
+            if 'sender' in filters and msg.sender_identity not in filters['sender']:
+                return False
+            if 'group' in filters and (msg.recipient_type != "group" or msg.recipient_identity not in filters['group']):
+                return False
+            if 'has_attachments' in filters and bool(msg.attachments) not in filters['has_attachments']:
+                return False
+            return True
+
+
+    FILTERS = ('message_type', 'sender', 'group', 'recipient_type', 'has_attachments', 'command')
+
+
+    def __init__(self):
+        self.routes = []
+        self.__order = 0
+        self.__compiled = False
+        self.__command_trie = {}
+        self.__by_group = {}
+        self.__by_sender = {}
+        self.__unindexed = []
+
+
+    def __len__(self):
+        return len(self.routes)
+
+
+    @staticmethod
+    def __normalize(value):
+        if isinstance(value, (str, bool, int)):
+            return frozenset([value])
+        return frozenset(value)
+
+
+    def add(self, callback_record, **filters):
+        """ Add a route for callback_record, filters are the keyword arguments of Signalcli.route(). Returns the Route """
+        normalized = {}
+        for name, value in filters.items():
+            if name not in Router.FILTERS:
+                raise TypeError("unknown route filter '" + name + "'")
+            if value is not None:
+                normalized[name] = Router.__normalize(value)
+        self.__order += 1
+        route = Router.Route(self.__order, callback_record, normalized)
+        self.routes.append(route)
+        self.__compiled = False
+        return route
+
+
+    def remove(self, callback_record):
+        """ Remove all routes of callback_record, returns True if any was removed """
+        remaining = [route for route in self.routes if route.callback_record is not callback_record]
+        removed = len(remaining) != len(self.routes)
+        if removed:
+            self.routes = remaining
+            self.__compiled = False
+        return removed
+
+
+    def __compile(self):
+        self.__command_trie = {}
+        self.__by_group = {}
+        self.__by_sender = {}
+        self.__unindexed = []
+        for route in self.routes:
+            filters = route.filters
+            if 'command' in filters:
+                for command in filters['command']:
+                    node = self.__command_trie
+                    for char in command:
+                        node = node.setdefault(char, {})
+                    node.setdefault(None, []).append(route)
+            elif 'group' in filters:
+                for group_id in filters['group']:
+                    self.__by_group.setdefault(group_id, []).append(route)
+            elif 'sender' in filters:
+                for sender in filters['sender']:
+                    self.__by_sender.setdefault(sender, []).append(route)
+            else:
+                self.__unindexed.append(route)
+        self.__compiled = True
+
+
+    def __match_commands(self, body, candidates):
+        """ Walk the trie along the message body, a command matches if it's followed by whitespace or the end of the body """
+        node = self.__command_trie
+        body_len = len(body)
+        for i, char in enumerate(body):
+            node = node.get(char)
+            if node is None:
+                return
+            if None in node and (i + 1 == body_len or body[i + 1].isspace()):
+                candidates.extend(node[None])
+
+
+    def match(self, msg):
+        """ List of callback records of the routes matching msg, in registration order """
+        if not self.__compiled:
+            self.__compile()
+        candidates = list(self.__unindexed)
+        if self.__command_trie and msg.message_body:
+            self.__match_commands(msg.message_body, candidates)
+        if self.__by_group and msg.recipient_type == "group":
+            candidates.extend(self.__by_group.get(msg.recipient_identity, ()))
+        if self.__by_sender:
+            candidates.extend(self.__by_sender.get(msg.sender_identity, ()))
+        if len(candidates) > 1:
+            candidates = sorted(set(candidates), key=lambda route: route.order)
+        return [route.callback_record for route in candidates if route.accepts(msg)]
@@ -2,9 +2,21 @@
 import sys
 import os
 import asyncio
-import json
 import time
 import datetime
+import collections
+import concurrent.futures
+import traceback
+
+from . import codec
+from .cache import DirectoryCache
+from .routing import Router
+from .journal import OutboundJournal
+from .metrics import Metrics
+from .broadcast import Broadcast
+from .attachments import Attachment, AttachmentStore
+from .dedupe import EnvelopeDedupe
+from .history import HistoryStore
 
 class Signalcli:
 
@@ -16,97 +28,229 @@ class Signalcli:
         it's created automatically and sent to the on('message') callback.
 
         Attributes
+            account             Identity (user_name) of the Signalcli object that received the message
             type                incoming_message|sent_message
             timestamp           Timestamp of message in epoch ms format
-            timestamp_iso8601   Timestamp of message in IS8601 format
+            timestamp_iso8601   Timestamp of message in IS8601 format (computed on first access)
             sender_identity     Identity of sender (phone-number)
             sender_device       Identity of sender device (integer)
-            sender_contact      Sender Contact object (if present in contact list)
+            sender_contact      Sender Contact object (if present in contact list, resolved on access)
             recipient_identity  Identity of recipient (phone-number or groupId or "__MYSELF__")
-            recipient_group     Recipient Group object (if sent to group chat and that group is present in the group list)
-            recipient_contact   Recipient Contact objet (if direct user-to-user message and present in contact list)
+            recipient_group     Recipient Group object (if sent to group chat and that group is present in the group list, resolved on access)
+            recipient_contact   Recipient Contact objet (if direct user-to-user message and present in contact list, resolved on access)
             recipient_type      direct|group
+            conversation_identity Identity of the chat the message belongs to (groupId, or the other party's phone-number)
             message_body        The message text itself
-            attachments         List of attachments
+            attachments         List of attachments (storagePath is added on first access)
 
         """
 
+        __slots__ = ('account', 'type', 'timestamp', 'sender_identity', 'sender_device', 'recipient_type', 'recipient_identity',
+                     'conversation_identity', 'message_body', '__raw_attachments', '__attachments', '__attachmentsPath',
+                     '__timestamp_iso8601', '__group_list', '__contact_list')
+
 
         class MessageParsingFailure(Exception):
             pass
 
 
         @staticmethod
-        def __epochms_to_iso8601(ms):
+        def epochms_to_iso8601(ms):
             return datetime.datetime.fromtimestamp((ms / 1000.0)).strftime('%Y-%m-%dT%H:%M:%S.%f')
 
 
+        @staticmethod
+        def parse_envelope(envelope):
+            """ Returns (type, content, recipient_type, recipient_identity) of an envelope, where content
+                is the dataMessage/sentMessage dict. Raises MessageParsingFailure for unsupported envelopes """
+            if envelope['dataMessage']:
+                content = envelope['dataMessage']
+                if content['groupInfo']:
+                    return "incoming_message", content, "group", content['groupInfo']['groupId']
+                return "incoming_message", content, "direct", "__MYSELF__"
+            elif envelope['syncMessage']:
+                content = envelope['syncMessage']['sentMessage']
+                if not content:
+                    raise Signalcli.Message.MessageParsingFailure()
+                if content['groupInfo']:
+                    return "sent_message", content, "group", content['groupInfo']['groupId']
+                return "sent_message", content, "direct", content['destination']
+            else:
+                ## unsupported message-type
+                raise Signalcli.Message.MessageParsingFailure()
+
+
+        @staticmethod
+        def resolve_attachments(raw_attachments, attachmentsPath):
+            """ Copy of the attachment list with storagePath prepended with attachmentsPath """
+            if not raw_attachments or not attachmentsPath:
+                return raw_attachments or []
+            return [dict(a, storagePath=os.path.join(attachmentsPath, a['id'])) for a in raw_attachments]
+
+
         def __str__(self):
             s = "Message (" + self.type +") From: " + self.sender_identity + "/" + str(self.sender_device) + " [" + self.timestamp_iso8601 + "]\n"
             if self.sender_contact:
                 s += "    Sender: " + str(self.sender_contact) + "\n"
             if self.recipient_contact:
-                s += "    Recipient: " + str(self.__contact_list[self.recipient_identity]) + "\n"
+                s += "    Recipient: " + str(self.recipient_contact) + "\n"
             else:
                 s += "    Recipient: " + self.recipient_identity + " (" + self.recipient_type + ")\n"
             if self.recipient_group:
                 s += "    Group: " + str(self.recipient_group) + "\n"
             for a in self.attachments:
-                s += " Attachment: Filename='" + str(a['filename']) + "', contentType='" + str(a['contentType']) + "', storagePath='" + str(a['storagePath']) + "'\n"
+                s += " Attachment: Filename='" + str(a['filename']) + "', contentType='" + str(a['contentType']) + "', storagePath='" + str(a.get('storagePath')) + "'\n"
             s += "    Message: " + self.message_body            
             return s
 
 
-        def __init__(self, envelope, group_list=None, contact_list=None, attachmentsPath=None):
+        @property
+        def timestamp_iso8601(self):
+            if self.__timestamp_iso8601 is None:
+                self.__timestamp_iso8601 = Signalcli.Message.epochms_to_iso8601(self.timestamp)
+            return self.__timestamp_iso8601
+
+
+        @property
+        def sender_contact(self):
+            if self.__contact_list:
+                return self.__contact_list.get(self.sender_identity)
+            return None
+
+
+        @property
+        def recipient_contact(self):
+            if self.__contact_list and self.recipient_type == "direct" and self.type == "sent_message":
+                return self.__contact_list.get(self.recipient_identity)
+            return None
+
+
+        @property
+        def recipient_group(self):
+            if self.__group_list and self.recipient_type == "group":
+                return self.__group_list.get(self.recipient_identity)
+            return None
+
+
+        @property
+        def attachments(self):
+            if self.__attachments is None:
+                self.__attachments = Signalcli.Message.resolve_attachments(self.__raw_attachments, self.__attachmentsPath)
+            return self.__attachments
+
+
+        def __init__(self, envelope, group_list=None, contact_list=None, attachmentsPath=None, account=None):
+            self.account = account
             self.__group_list = group_list
             self.__contact_list = contact_list
+            self.__attachmentsPath = attachmentsPath
+            self.__attachments = None
+            self.__timestamp_iso8601 = None
             self.timestamp = envelope['timestamp']
-            self.timestamp_iso8601 = Signalcli.Message.__epochms_to_iso8601(self.timestamp)
             self.sender_identity = envelope['source']
             self.sender_device = envelope['sourceDevice']
-            if contact_list and self.sender_identity in contact_list:
-                self.sender_contact = contact_list[self.sender_identity]
+            self.type, content, self.recipient_type, self.recipient_identity = Signalcli.Message.parse_envelope(envelope)
+            self.message_body = content['message']
+            self.__raw_attachments = content['attachments']
+            if self.recipient_type == "group" or self.type == "sent_message":
+                self.conversation_identity = self.recipient_identity
             else:
-                self.sender_contact = None
-            self.recipient_contact = None
-            self.recipient_group = None
-            if envelope['dataMessage']:
-                self.type = "incoming_message"
-                self.message_body = envelope['dataMessage']['message']
-                self.attachments = envelope['dataMessage']['attachments']
-                if envelope['dataMessage']['groupInfo']:
-                    self.recipient_type = "group"
-                    self.recipient_identity = envelope['dataMessage']['groupInfo']['groupId']
-                    if group_list and self.recipient_identity in group_list:
-                        self.recipient_group = group_list[self.recipient_identity]
-                else:
-                    self.recipient_type = "direct"
-                    self.recipient_identity = "__MYSELF__"
-            elif envelope['syncMessage']:
-                self.type = "sent_message"
-                if envelope['syncMessage']['sentMessage']:
-                    self.message_body = envelope['syncMessage']['sentMessage']['message']
-                    self.attachments = envelope['syncMessage']['sentMessage']['attachments']
-                    if envelope['syncMessage']['sentMessage']['groupInfo']:
-                        self.recipient_type = "group"
-                        self.recipient_identity = envelope['syncMessage']['sentMessage']['groupInfo']['groupId']
-                        if group_list and self.recipient_identity in group_list:
-                            self.recipient_group = group_list[self.recipient_identity]
-                    else:
-                        self.recipient_type = "direct"
-                        self.recipient_identity = envelope['syncMessage']['sentMessage']['destination']
-                        if contact_list and self.recipient_identity in contact_list:
-                            self.recipient_contact = contact_list[self.recipient_identity]
-                else:
-                    raise Signalcli.Message.MessageParsingFailure()
-            else:
-                ## unsupported message-type
+                self.conversation_identity = self.sender_identity
+
+
+
+    class MessageView:
+        """
+        Lightweight read-only view over a raw message envelope, with the same attributes as Message.
+        Every attribute is computed from the envelope when accessed, nothing is copied.
+        Sent to the on('message') callbacks instead of Message objects when Signalcli is created with message_view=True.
+
+        Attributes
+            envelope            The raw envelope
+            (all attributes of Message)
+        """
+
+        __slots__ = ('envelope', 'account', '__group_list', '__contact_list', '__attachmentsPath')
+
+        def __init__(self, envelope, group_list=None, contact_list=None, attachmentsPath=None, account=None):
+            if not envelope['dataMessage'] and not (envelope['syncMessage'] and envelope['syncMessage']['sentMessage']):
                 raise Signalcli.Message.MessageParsingFailure()
+            self.envelope = envelope
+            self.account = account
+            self.__group_list = group_list
+            self.__contact_list = contact_list
+            self.__attachmentsPath = attachmentsPath
+
+        def __str__(self):
+            return str(self.to_message())
+
+        def to_message(self):
+            """ Build a full Message object from the envelope """
+            return Signalcli.Message(self.envelope, group_list=self.__group_list, contact_list=self.__contact_list,
+                attachmentsPath=self.__attachmentsPath, account=self.account)
+
+        @property
+        def type(self):
+            return "incoming_message" if self.envelope['dataMessage'] else "sent_message"
+
+        @property
+        def timestamp(self):
+            return self.envelope['timestamp']
+
+        @property
+        def timestamp_iso8601(self):
+            return Signalcli.Message.epochms_to_iso8601(self.envelope['timestamp'])
+
+        @property
+        def sender_identity(self):
+            return self.envelope['source']
+
+        @property
+        def sender_device(self):
+            return self.envelope['sourceDevice']
+
+        @property
+        def sender_contact(self):
+            if self.__contact_list:
+                return self.__contact_list.get(self.envelope['source'])
+            return None
+
+        @property
+        def recipient_type(self):
+            return Signalcli.Message.parse_envelope(self.envelope)[2]
+
+        @property
+        def recipient_identity(self):
+            return Signalcli.Message.parse_envelope(self.envelope)[3]
+
+        @property
+        def conversation_identity(self):
+            message_type, content, recipient_type, recipient_identity = Signalcli.Message.parse_envelope(self.envelope)
+            if recipient_type == "group" or message_type == "sent_message":
+                return recipient_identity
+            return self.envelope['source']
+
+        @property
+        def recipient_contact(self):
+            message_type, content, recipient_type, recipient_identity = Signalcli.Message.parse_envelope(self.envelope)
+            if self.__contact_list and recipient_type == "direct" and message_type == "sent_message":
+                return self.__contact_list.get(recipient_identity)
+            return None
+
+        @property
+        def recipient_group(self):
+            message_type, content, recipient_type, recipient_identity = Signalcli.Message.parse_envelope(self.envelope)
+            if self.__group_list and recipient_type == "group":
+                return self.__group_list.get(recipient_identity)
+            return None
 
-            ## prepend attachmentsPath to attachment filename
-            if self.attachments and attachmentsPath:
-                for a in self.attachments:
-                    a['storagePath'] = os.path.join(attachmentsPath,a['id'])
+        @property
+        def message_body(self):
+            return Signalcli.Message.parse_envelope(self.envelope)[1]['message']
+
+        @property
+        def attachments(self):
+            return Signalcli.Message.resolve_attachments(Signalcli.Message.parse_envelope(self.envelope)[1]['attachments'], self.__attachmentsPath)
 
 
 
@@ -122,10 +266,16 @@ class Signalcli:
             blocked         Wether the user is blocked or not
         """
 
+        __slots__ = ('name', 'identity', 'color', 'profile_key', 'blocked')
+
         def __str__(self):
             return self.name + " (" + self.identity + ")"
 
         def __init__(self, contact_entry):
+            self.update(contact_entry)
+
+        def update(self, contact_entry):
+            """ Update the contact in place from a list_contacts entry """
             if contact_entry:
                 self.name = contact_entry['name']
                 self.identity = contact_entry['number']
@@ -150,38 +300,388 @@ class Signalcli:
             color           Color (name of the color)
             blocked         Wether the group is blocked
             active          Wether the group is active
-            members         List of Contact objects of members
+            members         List of Contact objects of members (resolved on access)
             members_id_list List of all member identities (phone-numbers)
         """
 
+        __slots__ = ('name', 'identity', 'color', 'blocked', 'active', 'members_id_list', '__contact_list', '__members')
+
         def __str__(self):
-            self.__member_resolve_contacts()
             member_list = list(map( lambda c: str(c), self.members))
             return self.name + " [" + str(member_list) + "]"
 
 
-        def __member_resolve_contacts(self):
-            self.members.clear()
-            for member_identity in self.members_id_list:
-                if member_identity in self.__contact_list:
-                    self.members.append(self.__contact_list[member_identity])
-                else:
-                    new_contact = Signalcli.Contact( None)
-                    new_contact.identity = member_identity
-                    new_contact.name = member_identity
-                    self.members.append(new_contact)
+        def __member_contact(self, member_identity):
+            if self.__contact_list and member_identity in self.__contact_list:
+                return self.__contact_list[member_identity]
+            new_contact = Signalcli.Contact( None)
+            new_contact.identity = member_identity
+            new_contact.name = member_identity
+            return new_contact
+
+
+        @property
+        def members(self):
+            if self.__members is None:
+                self.__members = [self.__member_contact(member_identity) for member_identity in self.members_id_list]
+            return self.__members
+
+
+        def invalidate_members(self):
+            """ Drop the cached members list, it's resolved again on next access """
+            self.__members = None
 
 
         def __init__(self, group_entry, contact_list):
             self.__contact_list = contact_list
+            self.update(group_entry)
+
+
+        def update(self, group_entry):
+            """ Update the group in place from a list_groups entry """
+            self.__members = None
             if group_entry:
                 self.name = group_entry['name']
                 self.identity = group_entry['groupId']
                 self.color = group_entry['color']
                 self.blocked = group_entry['blocked']
                 self.active = group_entry['active']
-                self.members = []
                 self.members_id_list = group_entry['members']
+            else:
+                self.name = "unknown"
+                self.identity = "unknown"
+                self.color = ""
+                self.blocked = False
+                self.active = False
+                self.members_id_list = []
+
+
+    class DirectoryChange:
+        """
+        Object that represents a change in the contact or group list, sent to the
+        on('contact_changed') and on('group_changed') callbacks.
+
+        Attributes
+            change          added|updated|removed
+            identity        Identity of the contact (phone-number) or group (groupId)
+            item            The Contact/Group object (for removed items, the object as it was before removal)
+            old_entry       Previous raw list entry from signal-cli (None if added)
+            new_entry       New raw list entry from signal-cli (None if removed)
+        """
+
+        __slots__ = ('change', 'identity', 'item', 'old_entry', 'new_entry')
+
+        def __str__(self):
+            return "DirectoryChange (" + self.change + ") " + str(self.item)
+
+        def __init__(self, change, identity, item, old_entry, new_entry):
+            self.change = change
+            self.identity = identity
+            self.item = item
+            self.old_entry = old_entry
+            self.new_entry = new_entry
+
+
+
+    class Directory:
+        """
+        Indexed contact and group lists, kept up to date from the list_contacts/list_groups results.
+
+        The contacts and groups dicts are updated in place (existing Contact/Group objects are kept and
+        updated), and a reverse index from member identity to groupIds is maintained so membership
+        lookups don't have to scan all groups.
+
+        Attributes
+            contacts        Dict of identity -> Contact
+            groups          Dict of groupId -> Group
+        """
+
+        def __init__(self, contacts=None, groups=None):
+            self.contacts = contacts if contacts is not None else {}
+            self.groups = groups if groups is not None else {}
+            self.__contact_entries = {}
+            self.__group_entries = {}
+            self.__member_index = {}
+
+
+        def groups_of(self, identity):
+            """ Set of groupIds the identity is member of """
+            return self.__member_index.get(identity, frozenset())
+
+
+        def is_member(self, identity, group_id):
+            """ Whether identity is member of the group """
+            return group_id in self.__member_index.get(identity, ())
+
+
+        def contact_entries(self):
+            """ The raw list_contacts entries, by identity """
+            return self.__contact_entries
+
+
+        def group_entries(self):
+            """ The raw list_groups entries, by groupId """
+            return self.__group_entries
+
+
+        def __index_members(self, group_id, member_ids, add):
+            for member_identity in member_ids:
+                if add:
+                    self.__member_index.setdefault(member_identity, set()).add(group_id)
+                else:
+                    group_ids = self.__member_index.get(member_identity)
+                    if group_ids:
+                        group_ids.discard(group_id)
+                        if not group_ids:
+                            del self.__member_index[member_identity]
+
+
+        def __invalidate_groups_of(self, identity):
+            for group_id in self.__member_index.get(identity, ()):
+                self.groups[group_id].invalidate_members()
+
+
+        def apply_contact_list(self, contact_entries, complete=True):
+            """ Apply a list_contacts result, returns the list of DirectoryChange objects.
+                If complete is True, contacts missing from the list are removed. """
+            changes = []
+            seen = set()
+            for entry in contact_entries:
+                identity = entry['number']
+                seen.add(identity)
+                old_entry = self.__contact_entries.get(identity)
+                if old_entry is None:
+                    contact = Signalcli.Contact(entry)
+                    self.contacts[identity] = contact
+                    changes.append(Signalcli.DirectoryChange("added", identity, contact, None, entry))
+                elif old_entry != entry:
+                    contact = self.contacts[identity]
+                    contact.update(entry)
+                    changes.append(Signalcli.DirectoryChange("updated", identity, contact, old_entry, entry))
+                else:
+                    continue
+                self.__contact_entries[identity] = entry
+                self.__invalidate_groups_of(identity)
+            if complete:
+                for identity in [identity for identity in self.__contact_entries if identity not in seen]:
+                    old_entry = self.__contact_entries.pop(identity)
+                    changes.append(Signalcli.DirectoryChange("removed", identity, self.contacts.pop(identity), old_entry, None))
+                    self.__invalidate_groups_of(identity)
+            return changes
+
+
+        def apply_group_list(self, group_entries, complete=True):
+            """ Apply a list_groups result, returns the list of DirectoryChange objects.
+                If complete is True, groups missing from the list are removed. """
+            changes = []
+            seen = set()
+            for entry in group_entries:
+                group_id = entry['groupId']
+                seen.add(group_id)
+                old_entry = self.__group_entries.get(group_id)
+                if old_entry is None:
+                    group = Signalcli.Group(entry, self.contacts)
+                    self.groups[group_id] = group
+                    self.__index_members(group_id, entry['members'], True)
+                    changes.append(Signalcli.DirectoryChange("added", group_id, group, None, entry))
+                elif old_entry != entry:
+                    group = self.groups[group_id]
+                    if old_entry['members'] != entry['members']:
+                        self.__index_members(group_id, old_entry['members'], False)
+                        self.__index_members(group_id, entry['members'], True)
+                    group.update(entry)
+                    changes.append(Signalcli.DirectoryChange("updated", group_id, group, old_entry, entry))
+                else:
+                    continue
+                self.__group_entries[group_id] = entry
+            if complete:
+                for group_id in [group_id for group_id in self.__group_entries if group_id not in seen]:
+                    old_entry = self.__group_entries.pop(group_id)
+                    self.__index_members(group_id, old_entry['members'], False)
+                    changes.append(Signalcli.DirectoryChange("removed", group_id, self.groups.pop(group_id), old_entry, None))
+            return changes
+
+
+
+    class SendResult:
+        """
+        Object that represents the outcome of a send_message request.
+        The future returned by send_message()/reply() resolves with one of these.
+
+        Attributes
+            reqID           Request ID the request was sent with
+            response        The raw response object from signal-cli
+            latency         Seconds from enqueueing the request until the response arrived
+        """
+
+        def __str__(self):
+            return "SendResult (reqID=" + str(self.reqID) + ", latency=" + "{0:.3f}".format(self.latency) + "s)"
+
+        def __init__(self, reqID, response, latency):
+            self.reqID = reqID
+            self.response = response
+            self.latency = latency
+
+
+    class MessageStream:
+        """
+        Bounded async iterator over incoming messages, returned by Signalcli.messages()
+
+            async with sig.messages(maxsize=100, overflow="drop_oldest") as stream:
+                async for msg in stream:
+                    ...
+
+        Attributes
+            maxsize         Max number of buffered messages
+            overflow        block|drop_oldest|drop_newest, what to do when the buffer is full
+            dropped         Number of messages dropped because the buffer was full
+            closed          Whether the stream has been closed
+        """
+
+        OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+        __end = object()
+
+        def __init__(self, sigcli_obj, message_filter=None, maxsize=100, overflow="block"):
+            if overflow not in Signalcli.MessageStream.OVERFLOW_POLICIES:
+                raise ValueError("overflow must be one of " + ", ".join(Signalcli.MessageStream.OVERFLOW_POLICIES))
+            self.__sigcli_obj = sigcli_obj
+            self.__filter = message_filter
+            ## the buffer is bounded by put() and the backpressure of the incoming worker, not by the queue
+            self.__queue = asyncio.Queue()
+            self.__room = asyncio.Event()
+            self.maxsize = maxsize
+            self.overflow = overflow
+            self.dropped = 0
+            self.closed = False
+
+        def accepts(self, msg):
+            return not self.closed and (self.__filter is None or self.__filter(msg))
+
+        def put(self, msg):
+            """ Add msg to the buffer according to the overflow policy, never waits. With overflow="block" the message
+                is always added, the incoming worker holds envelopes back while is_full() """
+            if self.overflow != "block" and 0 < self.maxsize <= self.__queue.qsize():
+                self.dropped += 1
+                if self.overflow == "drop_oldest":
+                    self.__queue.get_nowait()
+                    self.__queue.put_nowait(msg)
+            else:
+                self.__queue.put_nowait(msg)
+
+        def is_full(self):
+            """ Whether this is an open blocking stream with maxsize or more buffered messages """
+            return self.overflow == "block" and not self.closed and 0 < self.maxsize <= self.__queue.qsize()
+
+        async def wait_for_room(self):
+            """ Wait until is_full() is False, i.e. the consumer has read a message or the stream was closed """
+            while self.is_full():
+                self.__room.clear()
+                await self.__room.wait()
+
+        def close(self):
+            """ Stop the stream, iteration ends after the buffered messages have been consumed """
+            if self.closed:
+                return
+            self.closed = True
+            self.__sigcli_obj.remove_stream(self)
+            self.__room.set()
+            if self.__queue.empty():
+                self.__queue.put_nowait(Signalcli.MessageStream.__end)
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.closed and self.__queue.empty():
+                raise StopAsyncIteration
+            msg = await self.__queue.get()
+            self.__room.set()
+            if msg is Signalcli.MessageStream.__end:
+                raise StopAsyncIteration
+            return msg
+
+        async def get(self):
+            """ Next message, raises StopAsyncIteration when the stream is closed """
+            return await self.__anext__()
+
+        def qsize(self):
+            return self.__queue.qsize()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            self.close()
+            ## nobody reads the buffered messages anymore
+            while not self.__queue.empty():
+                self.__queue.get_nowait()
+
+
+
+    class ProcessEvent:
+        """
+        Object that represents a change in the state of the signal-cli subprocess, sent to the
+        on('process_exited') and on('process_restarted') callbacks.
+
+        Attributes
+            event           exited|restarted
+            returncode      Exit code of the process (exited)
+            downtime        Seconds from the exit until the restarted process completed its handshake (restarted)
+            attempts        Number of start attempts it took (restarted)
+            replayed        Number of unanswered requests that were sent again (restarted)
+        """
+
+        __slots__ = ('event', 'returncode', 'downtime', 'attempts', 'replayed')
+
+        def __str__(self):
+            if self.event == "exited":
+                return "ProcessEvent (exited, returncode=" + str(self.returncode) + ")"
+            return "ProcessEvent (restarted, downtime=" + "{0:.3f}".format(self.downtime) + "s, attempts=" + str(self.attempts) + ", replayed=" + str(self.replayed) + ")"
+
+        def __init__(self, event, returncode=None, downtime=None, attempts=None, replayed=None):
+            self.event = event
+            self.returncode = returncode
+            self.downtime = downtime
+            self.attempts = attempts
+            self.replayed = replayed
+
+
+    class TokenBucket:
+        """
+        Token bucket rate limiter, allows 'rate' operations per second with bursts of up to 'burst' operations
+        """
+
+        def __init__(self, rate, burst=None):
+            self.rate = float(rate)
+            self.burst = float(burst) if burst else max(1.0, self.rate)
+            self.tokens = self.burst
+            self.timestamp = time.monotonic()
+
+        def __refill(self):
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+
+        def has_token(self):
+            self.__refill()
+            return self.tokens >= 1.0
+
+        def consume(self):
+            """ Take one token if available, returns True on success """
+            if self.has_token():
+                self.tokens -= 1.0
+                return True
+            return False
+
+        def delay(self):
+            """ Seconds until the next token is available """
+            self.__refill()
+            return max(0.0, (1.0 - self.tokens) / self.rate)
+
+        def is_full(self):
+            self.__refill()
+            return self.tokens >= self.burst
 
 
     class SignalcliUsernameError(Exception):
@@ -192,10 +692,40 @@ class Signalcli:
         pass
 
 
+    class SignalcliTimeoutError(SignalcliSendError):
+        """ No response within the timeout. written is True if the request had already been written to signal-cli,
+            which may still send the message """
+        def __init__(self, message, written=False):
+            super().__init__(message)
+            self.written = written
+
+
+    class SignalcliQueueFullError(SignalcliSendError):
+        pass
+
+
+    class SignalcliHistoryError(Exception):
+        pass
+
+
+    ## events that can be subscribed to with on()
+    EVENTS = ('message', 'error', 'contact_changed', 'group_changed', 'process_exited', 'process_restarted')
+
+    ## max number of requests written to signal-cli with one write()
+    OUTGOING_BATCH_SIZE = 256
+
+    ## max number of envelopes held back by a full MessageStream while frames are read to find responses,
+    ## beyond it the responses wait too (until they time out)
+    INCOMING_HELD_MAX = 1000
+
+
     def exit_program(self):
         """ Exit the program (nicely), may be called from the event listener callbacks """
         self.__debug_out("exit_program")
-        self.signalcli_api_ping_task.cancel()
+        if self.signalcli_api_ping_task:
+            self.signalcli_api_ping_task.cancel()
+        if self.callback_executor and self.owns_callback_executor:
+            self.callback_executor.shutdown(wait=False)
         if self.incoming_json_queue:
             self.incoming_json_queue.join()
         self.async_loop.stop()
@@ -222,19 +752,81 @@ class Signalcli:
 
 
     def __process_group_list(self, new_group_list):
-        for group_list_entry in new_group_list:
-            self.group_list[group_list_entry['groupId']] = Signalcli.Group(group_list_entry, self.contact_list)
+        changes = self.directory.apply_group_list(new_group_list)
+        for change in changes:
+            self.__call_event_callback('group_changed', change, change.identity)
+        if changes and self.directory_cache:
+            self.async_loop.create_task(self.__store_directory_changes(self.directory_cache.store_group_changes(changes)))
 
 
     def __process_contact_list(self, new_contact_list):
-        for contact_list_entry in new_contact_list:
-            self.contact_list[contact_list_entry['number']] = Signalcli.Contact(contact_list_entry)
+        changes = self.directory.apply_contact_list(new_contact_list)
+        for change in changes:
+            self.__call_event_callback('contact_changed', change, change.identity)
+        if changes and self.directory_cache:
+            self.async_loop.create_task(self.__store_directory_changes(self.directory_cache.store_contact_changes(changes)))
+
+
+    async def __store_directory_changes(self, store_future):
+        try:
+            await asyncio.wrap_future(store_future)
+        except Exception as e:
+            self.__error_out("failed to write directory cache " + self.directory_cache.path + ": " + repr(e))
+
+
+    def __history_written(self, write_future):
+        """ Runs in the history thread """
+        if write_future.exception():
+            self.__error_out("failed to write message history " + self.history.path + ": " + repr(write_future.exception()))
+
+
+    def __dedupe_written(self, write_future):
+        """ Runs in the dedupe thread """
+        if write_future.exception():
+            self.__error_out("failed to write dedupe index " + self.dedupe.path + ": " + repr(write_future.exception()))
+
+
+    def __journal_written(self, write_future):
+        """ Runs in the journal thread """
+        if write_future.exception():
+            self.__error_out("failed to write outbound journal: " + repr(write_future.exception()))
+
+
+    def __flush_journal(self):
+        """ Start writing the journal records collected on the loop, returns the future of the write or None """
+        write_future = self.journal.flush()
+        if write_future:
+            write_future.add_done_callback(self.__journal_written)
+        return write_future
+
+
+    def __load_directory_cache(self):
+        try:
+            contact_entries, group_entries = self.directory_cache.load()
+        except Exception as e:
+            self.__error_out("failed to load directory cache " + self.directory_cache.path + ": " + repr(e))
+            return
+        self.directory.apply_contact_list(contact_entries)
+        self.directory.apply_group_list(group_entries)
+        self.__debug_out("loaded " + str(len(contact_entries)) + " contacts and " + str(len(group_entries)) + " groups from " + self.directory_cache.path)
+
+
+    def groups_of(self, identity):
+        """ List of Group objects the identity (phone-number) is member of """
+        return [self.group_list[group_id] for group_id in self.directory.groups_of(identity)]
+
+
+    def is_member(self, identity, group_id):
+        """ Whether identity (phone-number) is member of the group """
+        return self.directory.is_member(identity, group_id)
 
 
     async def __signalcli_api_ping( self):
         while True:
             await asyncio.sleep(2)
-            await self.__send_json({ "reqType": "alive"})
+            self.alive_ping_timestamp = time.monotonic()
+            self.signal_cli_proc.stdin.write(codec.ALIVE_REQUEST_FRAME)
+            await self.signal_cli_proc.stdin.drain()
 
 
     def __get_reqID(self):
@@ -242,36 +834,256 @@ class Signalcli:
         return self.reqID_counter
 
 
-    def reply( self, original_message, message_body, attachments = [], reply_to_sent_messages=False):
+    def __add_pending_request(self, req, timeout):
+        """ Register req in the pending request table, returns the future that resolves with its response """
+        reqID = req['reqID']
+        future = self.async_loop.create_future()
+        pending = { 'future': future, 'request': req, 'timestamp': time.monotonic(), 'timer': None, 'written': False, 'pinned': [] }
+        if timeout:
+            pending['timer'] = self.async_loop.call_later(timeout, self.__expire_pending_request, reqID)
+        self.pending_requests[reqID] = pending
+        future.add_done_callback(lambda f: self.__discard_pending_request(reqID))
+        ## callers that don't look at the result (like reply() used fire-and-forget) shouldn't get
+        ## "Future exception was never retrieved" logged for every failed send
+        future.add_done_callback(Signalcli.__retrieve_exception)
+        return future
+
+
+    @staticmethod
+    def __retrieve_exception(future):
+        if not future.cancelled():
+            future.exception()
+
+
+    def __discard_pending_request(self, reqID):
+        pending = self.pending_requests.pop(reqID, None)
+        if pending and pending['timer']:
+            pending['timer'].cancel()
+        if pending and pending['written']:
+            self.requests_in_flight -= 1
+        if pending:
+            self.__unpin_attachments(pending['pinned'])
+
+
+    def __pin_attachments(self, attachments):
+        """ Keep the staged copies of the Attachment objects from being evicted, returns the pinned ones """
+        pinned = [a for a in attachments if isinstance(a, Attachment)]
+        for attachment in pinned:
+            self.attachment_store.pin(attachment)
+        return pinned
+
+
+    def __unpin_attachments(self, pinned):
+        for attachment in pinned:
+            self.attachment_store.unpin(attachment)
+
+
+    def __expire_pending_request(self, reqID):
+        pending = self.pending_requests.get(reqID)
+        if pending and not pending['future'].done():
+            if self.metrics:
+                self.metrics.inc('signalcli_request_errors_total', self.metrics_labels + (('reason', 'timeout'),))
+            pending['future'].set_exception(Signalcli.SignalcliTimeoutError("No response to reqID " + str(reqID) + " within timeout",
+                written=pending['written']))
+
+
+    def __resolve_pending_request(self, data_object):
+        reqID = data_object.get('reqID')
+        if self.journal:
+            ## answered, also if the caller has stopped waiting for it
+            self.journal.record_done(reqID)
+        pending = self.pending_requests.get(reqID)
+        if not pending:
+            self.__debug_out("response for unknown/expired reqID " + str(reqID))
+            return
+        future = pending['future']
+        if future.done():
+            return
+        latency = time.monotonic() - pending['timestamp']
+        if self.metrics:
+            self.metrics.observe('signalcli_request_seconds', self.metrics_labels, latency)
+        if data_object.get('error'):
+            if self.metrics:
+                self.metrics.inc('signalcli_request_errors_total', self.metrics_labels + (('reason', 'error'),))
+            future.set_exception(Signalcli.SignalcliSendError("reqID " + str(reqID) + ": " + str(data_object['error'])))
+        else:
+            future.set_result(Signalcli.SendResult(reqID, data_object, latency))
+
+
+    def reply( self, original_message, message_body, attachments = [], reply_to_sent_messages=False, timeout=None):
         """ Reply to a message
         Parameters
             original_message            Message object we want to reply to
             message_body                Text to reply with
             attachments                 List of attachments to send with the reply
             reply_to_sent_messages      Wether to reply also to sent_messages (our own messages) or just someone elses messages
+            timeout                     See send_message()
+
+        With reply_coalesce_window set, replies to the same conversation are held for up to that many seconds and
+        sent as one message (see flush_replies()), every caller gets the SendResult of the merged request.
+
+        Return:
+            Future as returned by send_message(), or None if the message was not replied to
         """ 
         if original_message.type == "incoming_message" or (reply_to_sent_messages and original_message.type == "sent_message"):
             if original_message.recipient_type == "group":
-                self.send_message(original_message.recipient_identity, message_body, recipient_type="group", attachments=attachments)
-            elif original_message.recipient_type == "direct":
-                if original_message.type == "sent_message":
-                    self.send_message(original_message.recipient_identity, message_body, recipient_type="direct", attachments=attachments)
-                else:
-                    self.send_message(original_message.sender_identity, message_body, recipient_type="direct", attachments=attachments)
+                recipient_identity = original_message.recipient_identity
+            elif original_message.type == "sent_message":
+                recipient_identity = original_message.recipient_identity
+            else:
+                recipient_identity = original_message.sender_identity
+            if self.reply_coalesce_window is None:
+                return self.send_message(recipient_identity, message_body, recipient_type=original_message.recipient_type, attachments=attachments, timeout=timeout)
+            if self.__in_foreign_thread():
+                return asyncio.run_coroutine_threadsafe(self.__coalesce_reply_from_thread(recipient_identity, original_message.recipient_type,
+                    message_body, attachments, timeout), self.async_loop)
+            return self.__coalesce_reply(recipient_identity, original_message.recipient_type, message_body, attachments, timeout)
+        return None
+
+
+    def __coalesce_reply(self, recipient_identity, recipient_type, message_body, attachments, timeout):
+        key = (recipient_type, recipient_identity)
+        batch = self.coalesced_replies.get(key)
+        if batch and batch['size'] + len(self.reply_coalesce_separator) + len(message_body) > self.reply_coalesce_max_size:
+            self.__flush_coalesced_replies(key)
+            batch = None
+        if batch is None:
+            batch = self.coalesced_replies[key] = { 'bodies': [], 'attachments': [], 'pinned': [], 'futures': [], 'size': 0, 'timeout': timeout,
+                'timer': self.async_loop.call_later(self.reply_coalesce_window, self.__flush_coalesced_replies, key) }
+        else:
+            batch['size'] += len(self.reply_coalesce_separator)
+            if timeout is not None:
+                batch['timeout'] = timeout if batch['timeout'] is None else min(timeout, batch['timeout'])
+        future = self.async_loop.create_future()
+        future.add_done_callback(Signalcli.__retrieve_exception)
+        batch['bodies'].append(message_body)
+        batch['attachments'].extend(attachments)
+        batch['pinned'].extend(self.__pin_attachments(attachments))
+        batch['futures'].append(future)
+        batch['size'] += len(message_body)
+        if batch['size'] >= self.reply_coalesce_max_size:
+            self.__flush_coalesced_replies(key)
+        return future
+
+
+    async def __coalesce_reply_from_thread(self, *args):
+        return await self.__coalesce_reply(*args)
+
+
+    def __flush_coalesced_replies(self, key):
+        """ Send the held replies to one recipient as a single message, returns the future of the request or None """
+        batch = self.coalesced_replies.pop(key, None)
+        if not batch:
+            return None
+        batch['timer'].cancel()
+        ## from here on the request pins the attachments
+        self.__unpin_attachments(batch['pinned'])
+        ## replies whose future was cancelled are left out
+        parts = [(body, future) for body, future in zip(batch['bodies'], batch['futures']) if not future.cancelled()]
+        if not parts:
+            return None
+        futures = [future for body, future in parts]
+        recipient_type, recipient_identity = key
+        try:
+            send_future = self.send_message(recipient_identity, self.reply_coalesce_separator.join(body for body, future in parts),
+                recipient_type=recipient_type, attachments=batch['attachments'], timeout=batch['timeout'])
+        except Signalcli.SignalcliSendError as e:
+            for future in futures:
+                future.set_exception(e)
+            return None
+        if self.metrics and len(futures) > 1:
+            self.metrics.inc('signalcli_coalesced_replies_total', self.metrics_labels, len(futures) - 1)
+        send_future.add_done_callback(lambda f: Signalcli.__complete_coalesced_replies(f, futures))
+        return send_future
+
+
+    @staticmethod
+    def __complete_coalesced_replies(send_future, futures):
+        for future in futures:
+            if future.done():
+                continue
+            if send_future.cancelled():
+                future.cancel()
+            elif send_future.exception():
+                future.set_exception(send_future.exception())
+            else:
+                future.set_result(send_future.result())
 
 
-    def send_message( self, recipient_identity, message_body, recipient_type="direct", attachments = []):
-        """ Send a message
+    def flush_replies( self, conversation=None):
+        """ Send the replies held by reply coalescing now, to one conversation (recipient identity) or to all of them
 
-        Parameters
-            recipient_type              direct|group
-            recipient_identity          If recipient is group, this is the groupId, if it's direct message, the recipients phone-number
-            message_body                The text message to send
-            attachments                 List of filenames to attach to the message
+        Return:
+            List of the futures of the merged send_message requests
         """
+        send_futures = []
+        for key in list(self.coalesced_replies):
+            if conversation is None or key[1] == conversation:
+                send_future = self.__flush_coalesced_replies(key)
+                if send_future:
+                    send_futures.append(send_future)
+        return send_futures
+
+
+    async def __send_held_replies(self):
+        """ Called by stop(): write the replies held by reply coalescing directly (the outgoing worker is stopped,
+            rate limits don't apply) and wait for their responses, bounded by send_timeout, while signal-cli still runs """
+        send_futures = self.flush_replies()
+        if not send_futures or not self.process_ready.is_set():
+            return
+        self.outgoing_worker.cancel()
+        flushed = set(send_futures)
+        batch = [pending['request'] for reqID, pending in sorted(self.pending_requests.items())
+                 if pending['future'] in flushed and not pending['written']]
+        for req in batch:
+            self.pending_requests[req['reqID']]['written'] = True
+        self.requests_in_flight += len(batch)
+        self.request_written.set()
+        if self.journal:
+            write_future = self.__flush_journal()
+            if write_future and self.journal.fsync:
+                try:
+                    await asyncio.wrap_future(write_future)
+                except Exception:
+                    pass
+        if self.metrics:
+            self.metrics.inc('signalcli_requests_written_total', self.metrics_labels, len(batch))
+        try:
+            await self.__write_json_batch(batch)
+        except ConnectionError as e:
+            self.__error_out("failed to write held replies to signal-cli: " + repr(e))
+            return
+        answered = asyncio.ensure_future(asyncio.wait(send_futures))
+        exited = asyncio.ensure_future(self.signal_cli_proc.wait())
+        try:
+            ## the responses can't arrive anymore once signal-cli has exited
+            await asyncio.wait((answered, exited), timeout=self.send_timeout or None, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            answered.cancel()
+            exited.cancel()
+
+
+    def __in_foreign_thread(self):
+        """ True if called from another thread (e.g. an executor callback) while the event loop is running """
+        try:
+            if asyncio.get_running_loop() is self.async_loop:
+                return False
+        except RuntimeError:
+            pass
+        return self.async_loop.is_running()
+
+
+    async def __send_message_from_thread(self, *args, **kwargs):
+        return await self.send_message(*args, **kwargs)
+
+
+    def __build_send_request(self, recipient_identity, message_body, recipient_type, attachments):
         attachmentsList = []
         for a in attachments:
-            attachmentsList.appen({ 'filename': a})
+            if isinstance(a, Attachment):
+                self.attachment_store.touch(a)
+                a = a.path
+            attachmentsList.append({ 'filename': a})
         req = {
             "reqID": self.__get_reqID(),
             "reqType": "send_message",
@@ -290,71 +1102,521 @@ class Signalcli:
             }
         else:
             raise Signalcli.SignalcliSendError('recipient_type must be either "group" or "direct"')
+        return req
+
+
+    def send_message( self, recipient_identity, message_body, recipient_type="direct", attachments = [], timeout=None):
+        """ Send a message
+
+        Parameters
+            recipient_type              direct|group
+            recipient_identity          If recipient is group, this is the groupId, if it's direct message, the recipients phone-number
+            message_body                The text message to send
+            attachments                 List of filenames or Attachment objects (see stage_attachment()) to attach to the message
+            timeout                     Seconds to wait for the response from signal-cli (defaults to send_timeout, 0/None disables)
+
+        Return:
+            asyncio Future that resolves with a SendResult when signal-cli has responded to the request,
+            or fails with SignalcliSendError/SignalcliTimeoutError. Any number of sends may be in flight at once.
+            When called from a callback running in the executor thread pool a concurrent.futures.Future is returned instead.
+
+        Raises SignalcliQueueFullError if the outgoing queue is full, use send_message_async() to wait for room instead.
+        """
+        if self.__in_foreign_thread():
+            return asyncio.run_coroutine_threadsafe(self.__send_message_from_thread(recipient_identity, message_body,
+                recipient_type=recipient_type, attachments=attachments, timeout=timeout), self.async_loop)
+        if self.coalesced_replies:
+            ## held replies to this recipient go first
+            self.__flush_coalesced_replies((recipient_type, recipient_identity))
+        if self.__outgoing_queue_full():
+            raise Signalcli.SignalcliQueueFullError("outgoing queue is full (" + str(self.outgoing_queue_size) + " requests)")
+        return self.__queue_send_request(recipient_identity, message_body, recipient_type, attachments, timeout)
+
+
+    async def send_message_async( self, recipient_identity, message_body, recipient_type="direct", attachments = [], timeout=None):
+        """ Like send_message(), but waits for room in the outgoing queue instead of raising SignalcliQueueFullError
+
+        Return:
+            Future that resolves with a SendResult, i.e. "result = await (await sig.send_message_async(...))"
+        """
+        if self.coalesced_replies:
+            self.__flush_coalesced_replies((recipient_type, recipient_identity))
+        await self.__wait_for_outgoing_room()
+        return self.__queue_send_request(recipient_identity, message_body, recipient_type, attachments, timeout)
+
+
+    def __outgoing_queue_full(self):
+        return 0 < self.outgoing_queue_size <= self.unwritten_requests
+
+
+    async def __wait_for_outgoing_room(self):
+        while self.__outgoing_queue_full():
+            self.outgoing_room.clear()
+            await self.outgoing_room.wait()
+
+
+    def __queue_send_request(self, recipient_identity, message_body, recipient_type, attachments, timeout):
+        req = self.__build_send_request(recipient_identity, message_body, recipient_type, attachments)
+        future = self.__add_pending_request(req, self.send_timeout if timeout is None else timeout)
+        ## signal-cli reads the files after the request has been written
+        self.pending_requests[req['reqID']]['pinned'] = self.__pin_attachments(attachments)
+        self.__queue_request(req)
+        if self.journal:
+            self.journal.record_requests([req])
+        return future
+
+
+    def __queue_request(self, req):
+        """ Hand a request to the outgoing worker, it counts against outgoing_queue_size until it's written or dropped """
+        self.unwritten_requests += 1
         self.outgoing_json_queue.put_nowait(req)
 
 
+    def __release_requests(self, count):
+        """ count requests taken from the outgoing queue have been written or dropped """
+        self.unwritten_requests -= count
+        self.outgoing_room.set()
+
+
+    def broadcast( self, recipients, message_body, attachments = [], concurrency=50, retries=2, retry_backoff=1.0, timeout=None,
+                   checkpoint_path=None):
+        """ Send the same message to many recipients
+
+        Parameters
+            recipients                  Phone-numbers, groupIds, Contact or Group objects. Duplicates are sent once, groupIds
+                                        found in group_list are sent as group messages, the rest must be in contact_list or be
+                                        phone-numbers starting with '+' (other recipients fail with a LookupError)
+            message_body                Text to send
+            attachments                 List of filenames or Attachment objects to attach
+            concurrency=<n>             Max number of sends in flight, on top of the send_rate/recipient_send_rate limits
+            retries=<n>                 Times a send that timed out before it was written to signal-cli is retried, with
+                                        exponential backoff starting at retry_backoff seconds. Sends that timed out
+                                        after they were written (signal-cli may still send them) and errors reported
+                                        by signal-cli fail without retries
+            timeout                     Seconds to wait for each response (defaults to send_timeout)
+            checkpoint_path=<file>      Record the progress in this file, a broadcast started again with the same file
+                                        skips the recipients that already got the message
+
+        Return:
+            A running Broadcast job. Iterate it with "async for result in job" to get a BroadcastResult per recipient
+            as they complete, or "results = await job" for all of them. job.stats() has the progress and throughput,
+            job.cancel() stops it, stop() cancels the running broadcasts.
+        """
+        job = Broadcast(self, recipients, message_body, attachments=attachments, concurrency=concurrency, retries=retries,
+            retry_backoff=retry_backoff, timeout=timeout, checkpoint_path=checkpoint_path)
+        job.start()
+        self.broadcasts = [running for running in self.broadcasts if not running.done()] + [job]
+        return job
+
+
+    async def stage_attachment( self, path, content_type=None, filename=None):
+        """ Prepare a file for sending, see AttachmentStore.stage()
+
+        The file is hashed in a thread pool (and copied to attachment_staging_dir if set) the first time,
+        staging it again is served from the cache as long as the file doesn't change.
+
+        Return:
+            signalcli.attachments.Attachment with path, filename, size, content_type and digest, that can be
+            passed to send_message()/reply() any number of times
+        """
+        return await self.attachment_store.stage(path, content_type=content_type, filename=filename)
+
+
+    async def read_attachment( self, attachment):
+        """ Read a received attachment (an entry of msg.attachments), an Attachment or a file without blocking the event loop,
+            use attachment_store.iter_chunks() for large files """
+        return await self.attachment_store.read(attachment)
+
+
     async def __send_json( self, data_object):
-        json_str = json.dumps(data_object)
+        json_bytes = self.json_codec.dumps(data_object)
         if self.debug_io:
-            print( "send_json: " + json_str, file=sys.stderr)
-        json_str += "\n"
-        self.signal_cli_proc.stdin.write(json_str.encode('utf8'))
+            print( "send_json: " + json_bytes.decode('utf8'), file=sys.stderr)
+        self.signal_cli_proc.stdin.write(json_bytes + b"\n")
         await self.signal_cli_proc.stdin.drain()
 
 
+    async def __write_json_batch( self, data_objects):
+        """ Write several requests to signal-cli with a single write() and drain() """
+        dumps = self.json_codec.dumps
+        lines = [dumps(data_object) for data_object in data_objects]
+        if self.debug_io:
+            for json_bytes in lines:
+                print( "send_json: " + json_bytes.decode('utf8'), file=sys.stderr)
+        lines.append(b"")
+        self.signal_cli_proc.stdin.write(b"\n".join(lines))
+        await self.signal_cli_proc.stdin.drain()
+
+
+    @staticmethod
+    def __request_recipient(req):
+        if 'recipient' in req:
+            return req['recipient']['number']
+        return req['dataMessage']['groupInfo']['groupId']
+
+
+    def __recipient_bucket(self, recipient):
+        bucket = self.recipient_buckets.get(recipient)
+        if not bucket:
+            if len(self.recipient_buckets) >= 10000:
+                ## forget recipients that have been idle long enough to have a full bucket again
+                for k in [k for k, b in self.recipient_buckets.items() if b.is_full()]:
+                    del self.recipient_buckets[k]
+            bucket = Signalcli.TokenBucket(self.recipient_send_rate, self.recipient_send_burst)
+            self.recipient_buckets[recipient] = bucket
+        return bucket
+
+
+    def __is_waiting(self, req):
+        """ False if the caller has already been told the request failed (timed out, cancelled, signal-cli stopped) """
+        pending = self.pending_requests.get(req['reqID'])
+        return pending is not None and not pending['future'].done()
+
+
+    def __drop_request(self, req):
+        """ Forget a request the caller stopped waiting for before it was written, it isn't sent on the next start either """
+        self.__release_requests(1)
+        if self.journal:
+            self.journal.record_done(req['reqID'])
+
+
+    def __take_send_tokens(self, recipient):
+        """ Take the rate limit tokens for one request to recipient
+
+            Return:
+                None if the request may be written now, otherwise (seconds until it may be written, True if the global limit is hit)
+        """
+        if self.send_bucket and not self.send_bucket.has_token():
+            return self.send_bucket.delay(), True
+        if self.recipient_send_rate:
+            bucket = self.__recipient_bucket(recipient)
+            if not bucket.consume():
+                return bucket.delay(), False
+        if self.send_bucket:
+            self.send_bucket.consume()
+        return None
+
+
     async def __outgoing_json_queue_worker(self):
-        while True:
-            data_object = await self.outgoing_json_queue.get()
-            await self.__send_json(data_object)
+        ## requests held back by the rate limits, per recipient and in queue order, so a rate limited
+        ## recipient only holds back its own requests
+        ## (they still count against outgoing_queue_size)
+        deferred = {}
+        delay = None
+        getter = None
+        try:
+            while True:
+                incoming = []
+                if getter is None and self.outgoing_json_queue.empty():
+                    if not deferred:
+                        incoming.append(await self.outgoing_json_queue.get())
+                    else:
+                        getter = asyncio.ensure_future(self.outgoing_json_queue.get())
+                if getter is not None:
+                    if not getter.done():
+                        ## with held back requests, wait for new ones only until the next of them may be written
+                        await asyncio.wait((getter,), timeout=delay)
+                    if getter.done():
+                        incoming.append(getter.result())
+                        getter = None
+                ## while requests are held back, the queue is drained completely so requests to other
+                ## recipients aren't stuck behind them
+                while not self.outgoing_json_queue.empty() and (deferred or len(incoming) < Signalcli.OUTGOING_BATCH_SIZE):
+                    incoming.append(self.outgoing_json_queue.get_nowait())
+
+                batch = []
+                delay = None
+                global_blocked = False
+                for recipient in list(deferred):
+                    held = deferred[recipient]
+                    while held and not global_blocked and len(batch) < Signalcli.OUTGOING_BATCH_SIZE:
+                        if not self.__is_waiting(held[0]):
+                            self.__drop_request(held.popleft())
+                            continue
+                        blocked = self.__take_send_tokens(recipient)
+                        if blocked:
+                            delay = blocked[0] if delay is None else min(delay, blocked[0])
+                            global_blocked = blocked[1]
+                            break
+                        batch.append(held.popleft())
+                    if not held:
+                        del deferred[recipient]
+                for req in incoming:
+                    if not self.__is_waiting(req):
+                        self.__drop_request(req)
+                        continue
+                    recipient = Signalcli.__request_recipient(req)
+                    held = deferred.get(recipient)
+                    if held is None:
+                        if not global_blocked and len(batch) < Signalcli.OUTGOING_BATCH_SIZE:
+                            blocked = self.__take_send_tokens(recipient)
+                            if not blocked:
+                                batch.append(req)
+                                continue
+                            delay = blocked[0] if delay is None else min(delay, blocked[0])
+                            global_blocked = blocked[1]
+                        held = deferred[recipient] = collections.deque()
+                    held.append(req)
+                if deferred and delay is None:
+                    ## only held back by the batch size
+                    delay = 0
+
+                if self.journal:
+                    ## one background write per iteration for all the requests queued since the last one
+                    write_future = self.__flush_journal()
+                    if write_future and batch and self.journal.fsync:
+                        ## the requests have to be on disk before signal-cli may send them
+                        try:
+                            await asyncio.wrap_future(write_future)
+                        except Exception:
+                            pass
+                if batch:
+                    await self.process_ready.wait()
+                    ## requests that failed while waiting for signal-cli aren't written, the caller has been told they weren't sent
+                    waiting = []
+                    for req in batch:
+                        if self.__is_waiting(req):
+                            waiting.append(req)
+                        else:
+                            self.__drop_request(req)
+                    batch = waiting
+                if batch:
+                    for req in batch:
+                        self.pending_requests[req['reqID']]['written'] = True
+                    self.requests_in_flight += len(batch)
+                    self.request_written.set()
+                    self.__release_requests(len(batch))
+                    if self.metrics:
+                        self.metrics.inc('signalcli_requests_written_total', self.metrics_labels, len(batch))
+                    try:
+                        await self.__write_json_batch(batch)
+                    except ConnectionError as e:
+                        ## the requests stay in the pending table and are sent again if signal-cli is restarted
+                        self.__error_out("Signalcli::outgoing_json_queue_worker: write to signal-cli failed: " + repr(e))
+        finally:
+            if getter:
+                getter.cancel()
+            ## the requests taken from the queue are gone with the worker (their senders are failed by stop())
+            self.__release_requests(self.unwritten_requests - self.outgoing_json_queue.qsize())
 
 
     async def __incoming_json_queue_worker(self):
-        while True:
-            data_object = await self.incoming_json_queue.get()
-            respType = data_object['respType']
-            self.alive_timestamp = time.time()
-            if respType == "alive":
-                pass
-            elif respType == "metadata":
-                if data_object['apiVer'] != 2:
-                    self.__error_exit( "Signalcli::__incoming_json_queue_worker: Unknown apiVer: '" + data_object['apiVer'] + "'")
-                if data_object['attachmentsPath'] != "":
-                    self.attachmentsPath = data_object['attachmentsPath']
-                await self.__request_groups_and_contacts()
-            elif respType == "envelope":
-                if data_object['envelope']['dataMessage'] or data_object['envelope']['syncMessage']:
+        ## envelope frames held back while an overflow="block" MessageStream is full, in order
+        held = collections.deque()
+        getter = None
+        try:
+            while True:
+                if held:
+                    while held and not self.__full_stream():
+                        await self.__process_frame(held.popleft())
+                    self.__flush_stores()
+                if held:
+                    waiters = [asyncio.ensure_future(self.__full_stream().wait_for_room())]
+                    if self.requests_in_flight and len(held) < Signalcli.INCOMING_HELD_MAX:
+                        ## responses to written requests are still processed, a consumer waiting for one (e.g. "await
+                        ## sig.reply(...)" inside "async for msg in stream") would never read its stream again
+                        if getter is None:
+                            getter = asyncio.ensure_future(self.incoming_json_queue.get())
+                        waiters.append(getter)
+                    else:
+                        ## no more frames are read (and the stdout reader stops once incoming_json_queue
+                        ## is full) until the consumer catches up or sends a request
+                        self.request_written.clear()
+                        waiters.append(asyncio.ensure_future(self.request_written.wait()))
                     try:
-                        m = Signalcli.Message( data_object['envelope'], contact_list = self.contact_list, group_list = self.group_list, attachmentsPath = self.attachmentsPath)
-                        self.__call_event_callback( 'message', m)
-                    except Signalcli.Message.MessageParsingFailure:
-                        pass
-            elif respType == "list_groups":
-                self.__process_group_list(data_object['data'])
-            elif respType == "list_contacts":
-                self.__process_contact_list(data_object['data'])
-            elif respType == "send_message":
-                pass
-            else:
-                self.__error_out( 'Signalcli::incoming_json_queue_worker: Unknown respType="{0}"'.format(respType))
+                        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        for waiter in waiters:
+                            if waiter is not getter:
+                                waiter.cancel()
+                    if getter is None or not getter.done():
+                        continue
+                    batch = getter.result()
+                    getter = None
+                elif getter is not None:
+                    batch = await getter
+                    getter = None
+                else:
+                    batch = await self.incoming_json_queue.get()
+                self.alive_timestamp = time.time()
+                for data_object in batch:
+                    if (held or (self.streams and self.__full_stream())) and Signalcli.__is_envelope(data_object):
+                        held.append(data_object)
+                    else:
+                        await self.__process_frame(data_object)
+                self.__flush_stores()
+        finally:
+            if getter:
+                getter.cancel()
+
+
+    async def __process_frame(self, data_object):
+        try:
+            await self.__process_incoming_json(data_object)
+        except (KeyError, TypeError) as e:
+            self.__error_out( "Signalcli::incoming_json_queue_worker: malformed frame (" + repr(e) + "): " + str(data_object)[:200])
+
+
+    def __flush_stores(self):
+        """ Write what the processed frames added to the on-disk stores, in the background """
+        if self.dedupe is not None:
+            write_future = self.dedupe.flush()
+            if write_future:
+                write_future.add_done_callback(self.__dedupe_written)
+        if self.journal:
+            self.__flush_journal()
+        if self.history:
+            write_future = self.history.flush()
+            if write_future:
+                write_future.add_done_callback(self.__history_written)
+
+
+    @staticmethod
+    def __is_envelope(data_object):
+        return isinstance(data_object, dict) and data_object.get('respType') == "envelope"
+
+
+    def __full_stream(self):
+        """ An overflow="block" MessageStream without room for another message, None if there is none """
+        for stream in self.streams:
+            if stream.is_full():
+                return stream
+        return None
+
+
+    def __alive_response(self):
+        if self.alive_ping_timestamp:
+            self.alive_rtt = time.monotonic() - self.alive_ping_timestamp
+            self.alive_ping_timestamp = None
+            if self.metrics:
+                self.metrics.observe('signalcli_alive_rtt_seconds', self.metrics_labels, self.alive_rtt)
+
+
+    async def __process_incoming_json(self, data_object):
+        if data_object is codec.ALIVE_RESPONSE:
+            if self.metrics:
+                self.metrics.inc('signalcli_frames_total', self.metrics_labels + (('respType', 'alive'),))
+            self.__alive_response()
+            return
+        respType = data_object['respType']
+        if self.metrics:
+            self.metrics.inc('signalcli_frames_total', self.metrics_labels + (('respType', respType),))
+        if respType == "alive":
+            self.__alive_response()
+        elif respType == "metadata":
+            if data_object['apiVer'] != 2:
+                self.__error_exit( "Signalcli::__incoming_json_queue_worker: Unknown apiVer: '" + data_object['apiVer'] + "'")
+            if data_object['attachmentsPath'] != "":
+                self.attachmentsPath = data_object['attachmentsPath']
+            await self.__request_groups_and_contacts()
+            if self.restart_info:
+                restart_info = self.restart_info
+                self.restart_info = None
+                self.__call_event_callback('process_restarted', Signalcli.ProcessEvent("restarted",
+                    downtime=time.monotonic() - restart_info['exit_time'], attempts=restart_info['attempts'], replayed=restart_info['replayed']))
+        elif respType == "envelope":
+            envelope = data_object['envelope']
+            if envelope['dataMessage'] or envelope['syncMessage']:
+                if self.dedupe is not None and self.dedupe.is_duplicate(envelope):
+                    if self.metrics:
+                        self.metrics.inc('signalcli_duplicate_envelopes_total', self.metrics_labels)
+                    return
+                try:
+                    m = self.message_class( envelope, contact_list = self.contact_list, group_list = self.group_list, attachmentsPath = self.attachmentsPath, account = self.user_name)
+                    self.__call_event_callback( 'message', m, m.conversation_identity)
+                except Signalcli.Message.MessageParsingFailure:
+                    return
+                if self.history:
+                    self.history.add(envelope, m)
+                for stream in self.streams:
+                    try:
+                        accepted = stream.accepts(m)
+                    except Exception:
+                        self.__error_out("message stream filter raised:\n" + traceback.format_exc())
+                        continue
+                    if accepted:
+                        stream.put(m)
+        elif respType == "list_groups":
+            self.__process_group_list(data_object['data'])
+        elif respType == "list_contacts":
+            self.__process_contact_list(data_object['data'])
+        elif respType == "send_message":
+            self.__resolve_pending_request(data_object)
+        else:
+            self.__error_out( 'Signalcli::incoming_json_queue_worker: Unknown respType="{0}"'.format(respType))
+
+
+    def __decode_frames(self, frames):
+        """ Decode complete newline-delimited frames, bad or oversized frames are skipped """
+        batch = []
+        json_codec = self.json_codec
+        if self.metrics:
+            decode_start = time.perf_counter()
+        for frame in frames:
+            if json_codec.is_alive_frame(frame):
+                batch.append(codec.ALIVE_RESPONSE)
+                continue
+            if len(frame) > self.max_frame_size:
+                self.__error_out( "Signalcli::stdout_stream_reader: skipped frame of " + str(len(frame)) + " bytes (max_frame_size=" + str(self.max_frame_size) + ")")
+                continue
+            if not frame.strip():
+                continue
+            if self.debug_io:
+                print("stdout_stream_reader: " + frame.decode('utf8', 'replace'), file=sys.stderr)
+            try:
+                data_object = json_codec.loads(frame)
+            except json_codec.DecodeError as e:
+                self.__error_out( "Signalcli::stdout_stream_reader: JSONDecodeError: " + str(e))
+                continue
+            if isinstance(data_object, dict):
+                batch.append(data_object)
+        if self.metrics:
+            self.metrics.observe('signalcli_json_decode_seconds', self.metrics_labels, time.perf_counter() - decode_start)
+            self.metrics.inc('signalcli_frame_bytes_total', self.metrics_labels, sum(map(len, frames)))
+        return batch
 
 
     async def __stdout_stream_reader(self):
+        ## pieces of the (incomplete) last frame of the previous chunks
+        partial = []
+        partial_len = 0
+        skipping = False
         while True:
-            data_bytes = await self.signal_cli_proc.stdout.readline()
-            if len(data_bytes):
-                data_string = data_bytes.decode('utf8')
-                if self.debug_io:
-                    print("stdout_stream_reader: " + data_string, end=None)
-                try:
-                    data_object = json.loads(data_string)
-                except json.JSONDecodeError as e:
-                    self.__error_out( "Signalcli::stdout_stream_reader: JSONDecodeError: " + str(e))
-                if data_object:
-                    await self.incoming_json_queue.put(data_object)
-            else:
-                self.__error_debug("stdout_stream_reader: EOF", file=sys.stderr)
+            chunk = await self.signal_cli_proc.stdout.read(self.read_chunk_size)
+            if not chunk:
+                self.__debug_out("stdout_stream_reader: EOF")
                 break
-        self.exit_program()
+            if b"\n" not in chunk:
+                if not skipping:
+                    partial.append(chunk)
+                    partial_len += len(chunk)
+                    if partial_len > self.max_frame_size:
+                        self.__error_out( "Signalcli::stdout_stream_reader: skipping frame larger than max_frame_size=" + str(self.max_frame_size))
+                        partial = []
+                        partial_len = 0
+                        skipping = True
+                continue
+            frames = chunk.split(b"\n")
+            if skipping:
+                frames[0] = b""
+                skipping = False
+            elif partial:
+                partial.append(frames[0])
+                frames[0] = b"".join(partial)
+            last = frames.pop()
+            partial = [last] if last else []
+            partial_len = len(last)
+            batch = self.__decode_frames(frames)
+            if batch:
+                await self.incoming_json_queue.put(batch)
+        ## nothing can be written to signal-cli anymore
+        self.process_ready.clear()
+        if self.auto_restart and self.started:
+            self.tasks.append(self.async_loop.create_task(self.__restart_signal_cli_subprocess()))
+        elif self.exit_on_eof:
+            self.exit_program()
+        else:
+            self.async_loop.create_task(self.stop())
 
 
     async def __stderr_stream_reader(self):
@@ -381,36 +1643,164 @@ class Signalcli:
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
             universal_newlines=False)
-        self.async_loop.create_task(self.__stdout_stream_reader())
-        self.async_loop.create_task(self.__stderr_stream_reader())
+        self.process_start_time = time.monotonic()
+        self.process_tasks = [
+            self.async_loop.create_task(self.__stdout_stream_reader()),
+            self.async_loop.create_task(self.__stderr_stream_reader())
+        ]
         if self.alive_check:
             self.signalcli_api_ping_task = self.async_loop.create_task(self.__signalcli_api_ping())
+            self.process_tasks.append(self.signalcli_api_ping_task)
+
+
+    async def __restart_signal_cli_subprocess(self):
+        """ Supervisor: restart signal-cli with exponential backoff and send the unanswered requests again """
+        self.process_ready.clear()
+        exit_time = time.monotonic()
+        for task in self.process_tasks:
+            task.cancel()
+        returncode = await self.signal_cli_proc.wait()
+        self.__error_out("signal-cli exited with returncode " + str(returncode) + ", restarting")
+        self.__call_event_callback('process_exited', Signalcli.ProcessEvent("exited", returncode=returncode))
+        ## a process that didn't stay up for restart_backoff_max seconds counts as a failed start
+        if exit_time - self.process_start_time < self.restart_backoff_max:
+            self.restart_failures += 1
+        else:
+            self.restart_failures = 0
+        attempts = 0
+        while True:
+            if self.restart_failures:
+                await asyncio.sleep(min(self.restart_backoff_max, self.restart_backoff * 2 ** (self.restart_failures - 1)))
+            attempts += 1
+            try:
+                await self.__start_signal_cli_subprocess()
+                break
+            except OSError as e:
+                self.__error_out("failed to restart signal-cli: " + repr(e))
+                self.restart_failures += 1
+        replay = [pending['request'] for reqID, pending in sorted(self.pending_requests.items())
+                  if pending['written'] and not pending['future'].done()]
+        if replay:
+            try:
+                await self.__write_json_batch(replay)
+            except ConnectionError as e:
+                self.__error_out("failed to replay requests to signal-cli: " + repr(e))
+        self.restart_info = { 'exit_time': exit_time, 'attempts': attempts, 'replayed': len(replay) }
+        self.process_ready.set()
 
 
-    def __call_event_callback( self, event_name, event_obj):
-        if event_name in self.callbacks:
-            for cb in self.callbacks[event_name]:
-                if cb['callback']:
-                    cb['callback']( self, event_name, event_obj, *(cb['callback_data']))
+    def __call_event_callback( self, event_name, event_obj, conversation=None):
+        """ Dispatch event to the callbacks without blocking the caller.
+            Events with the same conversation key are delivered in order, different conversations run concurrently.
+        """
+        if not self.callbacks.get(event_name) and not (event_name == 'message' and len(self.router)):
+            return
+        if not self.ordered_conversations:
+            self.async_loop.create_task(self.__run_event_callbacks(event_name, event_obj))
+            return
+        key = (event_name, conversation)
+        if key in self.conversation_queues:
+            self.conversation_queues[key].append(event_obj)
+        else:
+            self.conversation_queues[key] = collections.deque([event_obj])
+            self.async_loop.create_task(self.__conversation_sequencer(key))
+
+
+    async def __conversation_sequencer(self, key):
+        event_name = key[0]
+        queue = self.conversation_queues[key]
+        try:
+            while queue:
+                await self.__run_event_callbacks(event_name, queue.popleft())
+        finally:
+            del self.conversation_queues[key]
+
+
+    async def __run_event_callbacks(self, event_name, event_obj):
+        callbacks = list(self.callbacks.get(event_name, []))
+        if event_name == 'message' and len(self.router):
+            callbacks.extend(self.router.match(event_obj))
+        metrics = self.metrics
+        for cb in callbacks:
+            if not cb['callback']:
+                continue
+            if metrics:
+                callback_start = time.perf_counter()
+            try:
+                await self.__invoke_callback(cb, event_name, event_obj)
+            except Exception as e:
+                if metrics:
+                    metrics.inc('signalcli_callback_errors_total', self.__callback_labels(cb, event_name))
+                self.__error_out("callback for '" + event_name + "' raised:\n" + traceback.format_exc())
+                if event_name != 'error':
+                    self.__call_event_callback('error', e)
+            finally:
+                if metrics:
+                    metrics.observe('signalcli_callback_seconds', self.__callback_labels(cb, event_name), time.perf_counter() - callback_start)
+
+
+    def __callback_labels(self, cb, event_name):
+        callback = cb['callback']
+        handler = getattr(callback, '__qualname__', None) or repr(callback)
+        return self.metrics_labels + (('event', event_name), ('handler', handler))
+
+
+    def get_metrics(self):
+        """ Dict snapshot of the metrics (see signalcli.metrics.Metrics.snapshot()), None if metrics are disabled """
+        if not self.metrics:
+            return None
+        return self.metrics.snapshot()
 
 
-    def on( self, event_name, callback, *callback_data):
+    def __register_metric_gauges(self):
+        labels = self.metrics_labels
+        self.metrics.set_gauge('signalcli_incoming_queue_depth', labels, self.incoming_json_queue.qsize)
+        self.metrics.set_gauge('signalcli_outgoing_queue_depth', labels, lambda: self.unwritten_requests)
+        self.metrics.set_gauge('signalcli_pending_requests', labels, lambda: len(self.pending_requests))
+        self.metrics.set_gauge('signalcli_active_conversations', labels, lambda: len(self.conversation_queues))
+
+
+    async def __invoke_callback(self, cb, event_name, event_obj):
+        callback = cb['callback']
+        args = (self, event_name, event_obj) + tuple(cb['callback_data'])
+        if asyncio.iscoroutinefunction(callback):
+            await callback(*args)
+        elif cb['run_in_executor'] and self.callback_executor:
+            await self.async_loop.run_in_executor(self.callback_executor, lambda: callback(*args))
+        else:
+            result = callback(*args)
+            if asyncio.iscoroutine(result):
+                await result
+
+
+    def on( self, event_name, callback, *callback_data, run_in_executor=None):
         """ Add event subscriber callback and optional callback_data arguments that will be passed to the called callback function
 
             Signature of the callback function:
                 callback(sigcli_object, event_name, event_object[, <callback_data arguments,...>])
 
+            The callback may be a coroutine function, it's then awaited without blocking other conversations.
+            Plain functions are run in the callback thread pool if run_in_executor is True (defaults to True
+            when the object was created with callback_workers > 0), otherwise they're called in the event loop.
+
             Return: 
                 callback_record object that can later be used to remove the callback.
 
             Events:
                 message         On incoming messages
-                error           On errors (currently not implemented!)
+                error           On errors (exceptions raised by callbacks)
+                contact_changed When a contact is added/updated/removed (event_object is a DirectoryChange)
+                group_changed   When a group is added/updated/removed (event_object is a DirectoryChange)
+                process_exited  When signal-cli exits and auto_restart is on (event_object is a ProcessEvent with returncode)
+                process_restarted   When signal-cli has been restarted (event_object is a ProcessEvent with downtime,
+                                attempts and replayed)
         """
-        if event_name in ['message','error']:
+        if event_name in Signalcli.EVENTS:
             if not event_name in self.callbacks:
                 self.callbacks[event_name] = []
-            new_callback_record = { 'callback': callback, 'callback_data': callback_data }
+            if run_in_executor is None:
+                run_in_executor = self.callback_executor is not None
+            new_callback_record = { 'callback': callback, 'callback_data': callback_data, 'run_in_executor': run_in_executor }
             self.callbacks[event_name].append(new_callback_record)
             return new_callback_record
         else:
@@ -418,8 +1808,37 @@ class Signalcli:
             return None
 
 
+    def route( self, callback, *callback_data, message_type=None, sender=None, group=None, recipient_type=None,
+               has_attachments=None, command=None, run_in_executor=None):
+        """ Add message callback that's only called for messages matching all the given filters.
+            Each filter accepts a single value or a list of accepted values, None means any value.
+
+            Filters:
+                message_type        incoming_message|sent_message
+                sender              Sender identity (phone-number)
+                group               groupId (only matches group messages)
+                recipient_type      direct|group
+                has_attachments     True|False
+                command             Command the message body starts with (e.g. '/log'), must be followed by whitespace or end of message
+
+            Routes are compiled into an index (a prefix trie over commands and hash tables over groups/senders),
+            so the cost of matching a message doesn't grow with the number of routes.
+            The callback signature and dispatch are the same as for on('message', ...).
+
+            Return:
+                callback_record object that can later be used to remove the callback with remove_callback().
+        """
+        if run_in_executor is None:
+            run_in_executor = self.callback_executor is not None
+        new_callback_record = { 'callback': callback, 'callback_data': callback_data, 'run_in_executor': run_in_executor }
+        self.router.add(new_callback_record, message_type=message_type, sender=sender, group=group, recipient_type=recipient_type,
+            has_attachments=has_attachments, command=command)
+        return new_callback_record
+
+
     def remove_callback( self, callback_record):
-        """  Remove callback provided the callback_record as returned by the "on('event_name', cb)" call """
+        """  Remove callback provided the callback_record as returned by the "on('event_name', cb)" or "route(cb, ...)" call """
+        self.router.remove(callback_record)
         for k_event_name,v_cb_list in self.callbacks.items():
             try:
                 v_cb_list.remove(callback_record)
@@ -427,17 +1846,178 @@ class Signalcli:
                 pass
 
 
+    def messages( self, filter=None, maxsize=100, overflow="block"):
+        """ Get an async iterator over incoming messages, as an alternative to on('message') callbacks
+
+            Parameters:
+                filter=<callable>           Only messages for which filter(msg) returns True are delivered
+                maxsize=<n>                 Max number of buffered messages
+                overflow=<policy>           block|drop_oldest|drop_newest. With block, a full buffer pauses the processing
+                                            of incoming frames (and eventually the reading from signal-cli) until the
+                                            consumer catches up, so memory stays bounded. Responses to sent messages
+                                            are still processed (holding the envelopes read meanwhile) while the
+                                            consumer waits for one
+
+            Return:
+                MessageStream, close it (or use it with "async with") when done, a blocking stream that's never
+                read pauses the processing of incoming messages
+        """
+        stream = Signalcli.MessageStream(self, filter, maxsize=maxsize, overflow=overflow)
+        self.streams = self.streams + [stream]
+        return stream
+
+
+    def remove_stream( self, stream):
+        """ Stop delivering messages to a MessageStream, called by MessageStream.close() """
+        self.streams = [s for s in self.streams if s is not stream]
+
+
+    async def get_history( self, conversation=None, sender=None, since=None, until=None, limit=50):
+        """ Get stored messages (requires history_dir), e.g. the last 50 messages of a group or everything from a sender today
+
+            Parameters:
+                conversation                conversation_identity of the messages (groupId or the other party's phone-number)
+                sender                      sender_identity of the messages
+                since/until                 Timestamp range in epoch ms (since inclusive, until exclusive)
+                limit                       Max number of messages, the newest ones are returned (0/None = all)
+
+            Return:
+                List of Message (or MessageView) objects, oldest first
+        """
+        if not self.history:
+            raise Signalcli.SignalcliHistoryError("no message history, create the Signalcli object with history_dir")
+        envelopes = await self.history.query(conversation=conversation, sender=sender, since=since, until=until, limit=limit)
+        messages = []
+        for envelope in envelopes:
+            try:
+                messages.append(self.message_class(envelope, contact_list=self.contact_list, group_list=self.group_list,
+                    attachmentsPath=self.attachmentsPath, account=self.user_name))
+            except Signalcli.Message.MessageParsingFailure:
+                pass
+        return messages
+
+
     def get_event_loop(self):
         """ Get the asyncio event loop object, for creating custom tasks etc """
         return self.async_loop
 
 
+    @classmethod
+    async def create(cls, **kwargs):
+        """ Create and start a Signalcli object from within a running event loop, takes the same arguments as the constructor
+
+            sig = await Signalcli.create(user_name="+46123456789")
+
+            Unless given, exit_on_eof defaults to False here, so an exiting signal-cli stops the object, not the event loop.
+        """
+        kwargs['autostart'] = False
+        kwargs.setdefault('event_loop', asyncio.get_running_loop())
+        kwargs.setdefault('exit_on_eof', False)
+        sig = cls(**kwargs)
+        await sig.start()
+        return sig
+
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+
     def run(self):
         """ Starts the asyncio event loop with run_forever(), mandatory to call when all is setup to get the application working """
         self.async_loop.run_forever()
 
 
-    def __init__(self, debug=False, event_loop=None, bin_path="signal-cli", user_name=None, alive_check=False):
+    async def start(self):
+        """ Start signal-cli and the queue workers. Called automatically from the constructor unless autostart=False.
+            A stopped object can't be started again (its journal, history and caches are closed), create a new one """
+        if self.started:
+            return
+        if self.stopped:
+            raise RuntimeError("Signalcli object for " + str(self.user_name) + " has been stopped, it can't be started again")
+        self.started = True
+        if self.metrics:
+            self.__register_metric_gauges()
+            if self.metrics_port:
+                await self.metrics.start_http_server(self.metrics_port)
+                self.metrics_server_started = True
+        await self.__start_signal_cli_subprocess()
+        self.process_ready.set()
+        self.tasks.append(self.async_loop.create_task(self.__incoming_json_queue_worker()))
+        self.outgoing_worker = self.async_loop.create_task(self.__outgoing_json_queue_worker())
+        self.tasks.append(self.outgoing_worker)
+        if self.journal:
+            for req in self.journal.load():
+                ## requests left unanswered by a previous run, nobody is waiting for their results
+                await self.__wait_for_outgoing_room()
+                self.__add_pending_request(req, self.send_timeout)
+                self.__queue_request(req)
+
+
+    async def stop(self):
+        """ Stop signal-cli and the queue workers without stopping the event loop, pending sends fail with SignalcliSendError.
+            Replies held by reply coalescing are sent first """
+        if not self.started:
+            return
+        self.started = False
+        self.stopped = True
+        ## their sends would only wait for an outgoing worker that's gone
+        for job in self.broadcasts:
+            job.cancel()
+        self.broadcasts = []
+        await self.__send_held_replies()
+        current_task = asyncio.current_task()
+        for task in self.tasks + self.process_tasks:
+            if task is not current_task:
+                task.cancel()
+        self.tasks = []
+        self.process_tasks = []
+        self.process_ready.clear()
+        for stream in self.streams:
+            stream.close()
+        if self.signal_cli_proc and self.signal_cli_proc.returncode is None:
+            self.signal_cli_proc.terminate()
+            ## the output left in the pipes is read and thrown away, with the reading paused by a full
+            ## MessageStream the pipes would never be closed and wait() never returns
+            await self.signal_cli_proc.communicate()
+        if self.journal:
+            ## keep the unanswered requests in the journal for the next run
+            self.journal.close()
+            self.journal = None
+        for pending in list(self.pending_requests.values()):
+            if not pending['future'].done():
+                pending['future'].set_exception(Signalcli.SignalcliSendError("signal-cli stopped before reqID " + str(pending['request']['reqID']) + " was answered"))
+        if self.callback_executor and self.owns_callback_executor:
+            self.callback_executor.shutdown(wait=False)
+        if self.directory_cache:
+            await self.async_loop.run_in_executor(None, self.directory_cache.close)
+            self.directory_cache = None
+        self.attachment_store.close()
+        if self.history:
+            await self.async_loop.run_in_executor(None, self.history.close)
+            self.history = None
+        if self.dedupe is not None:
+            await self.async_loop.run_in_executor(None, self.dedupe.close)
+        if self.metrics:
+            self.metrics.remove_gauges(self.metrics_labels)
+            if self.metrics_server_started:
+                ## the server is shared with the other accounts using this Metrics object, only the last one closes it
+                self.metrics_server_started = False
+                await self.metrics.stop_http_server()
+
+
+    def __init__(self, debug=False, event_loop=None, bin_path="signal-cli", user_name=None, alive_check=False, send_timeout=30.0,
+                 callback_workers=0, ordered_conversations=True, callback_executor=None, autostart=None, exit_on_eof=None,
+                 outgoing_queue_size=1000, send_rate=None, send_burst=None, recipient_send_rate=None, recipient_send_burst=None,
+                 read_chunk_size=256*1024, max_frame_size=64*1024*1024, json_codec=None, message_view=False, cache_dir=None,
+                 auto_restart=False, restart_backoff=1.0, restart_backoff_max=60.0, journal_dir=None, journal_fsync=False,
+                 metrics=None, metrics_port=None, incoming_queue_size=64, attachment_staging_dir=None,
+                 attachment_cache_size=256*1024*1024, dedupe_size=10000, dedupe_dir=None, history_dir=None, history_retention=None,
+                 reply_coalesce_window=None, reply_coalesce_max_size=2000, reply_coalesce_separator="\n"):
         """ Create new Signalcli object
             Parameters:
                 debug=(True/False)
@@ -445,6 +2025,42 @@ class Signalcli:
                 bin_path=<path>             Full path to signal-cli executable
                 user_name=<username>        (MANDATORY)Username to provide to signal-cli, usually phone number in international dialling format ('+XXYYYY..')
                 alive_check=(True/False)    Whether we should regularly check if signal-cli is still running
+                send_timeout=<seconds>      Default time to wait for signal-cli to respond to a send_message request
+                callback_workers=<n>        Run plain (non-coroutine) callbacks in a thread pool of n threads (0 = run them in the event loop)
+                ordered_conversations=(True/False)  Deliver messages of the same conversation in order (different conversations are always handled concurrently)
+                callback_executor=<executor>    Use an existing concurrent.futures executor for plain callbacks instead of creating one
+                autostart=(True/False)      Start signal-cli from the constructor, otherwise await start() (or use "async with").
+                                            Defaults to True unless the event loop is already running
+                exit_on_eof=(True/False)    Stop the event loop (exit_program) when signal-cli exits, otherwise only this object is stopped.
+                                            Defaults to True unless the event loop is already running (e.g. "async with" in asyncio.run())
+                outgoing_queue_size=<n>     Max number of outgoing messages not written to signal-cli yet, queued or held
+                                            back by the rate limits (0 = unbounded)
+                send_rate=<n>               Max messages per second sent in total (None = unlimited)
+                send_burst=<n>              Number of messages that may be sent in a burst before send_rate applies
+                recipient_send_rate=<n>     Max messages per second sent to a single recipient (None = unlimited)
+                recipient_send_burst=<n>    Burst size per recipient
+                read_chunk_size=<bytes>     Size of the chunks read from signal-cli's stdout
+                max_frame_size=<bytes>      Max size of a single JSON frame from signal-cli, larger frames are skipped
+                json_codec=<name>           JSON implementation to use (json|orjson|msgspec), default is the fastest one installed
+                message_view=(True/False)   Pass lightweight MessageView objects over the raw envelope to the callbacks instead of Message objects
+                cache_dir=<path>            Keep a persistent cache of contacts and groups in this directory, loaded on startup
+                auto_restart=(True/False)   Restart signal-cli when it exits and send unanswered requests again (instead of exit_on_eof handling)
+                restart_backoff=<seconds>   Initial delay between restarts when signal-cli keeps exiting, doubled for every failure
+                restart_backoff_max=<seconds>   Max delay between restarts
+                journal_dir=<path>          Keep a journal of unanswered outgoing requests in this directory, they're sent again on next start
+                journal_fsync=(True/False)  fsync() the journal after every write
+                metrics=(True/<Metrics>)    Collect runtime metrics (see get_metrics()), pass a signalcli.metrics.Metrics object to share one between accounts
+                metrics_port=<port>         Serve the metrics in Prometheus text format on 127.0.0.1:<port> (requires metrics)
+                incoming_queue_size=<n>     Max number of decoded chunks of frames waiting for the worker, reading from signal-cli pauses when full
+                attachment_staging_dir=<path>   Copy attachments staged with stage_attachment() to this content-addressed directory
+                attachment_cache_size=<bytes>   Max size of attachment_staging_dir, least recently sent files are removed first
+                dedupe_size=<n>             Number of recent envelopes remembered to drop ones signal-cli delivers again (0 = no deduplication)
+                dedupe_dir=<path>           Keep the recent envelopes in this directory, so duplicates are also dropped after a restart
+                history_dir=<path>          Store incoming and synced messages in a database in this directory, see get_history()
+                history_retention=<seconds> Delete messages older than this from the history (None = keep everything)
+                reply_coalesce_window=<seconds> Merge replies to the same conversation made within this time into one message (None = disabled)
+                reply_coalesce_max_size=<n> Send the merged reply right away when it reaches this many characters
+                reply_coalesce_separator=<str>  Text put between merged replies
         """
         if not event_loop:
             self.async_loop = asyncio.get_event_loop()
@@ -461,14 +2077,92 @@ class Signalcli:
         self.alive_check = alive_check
         self.user_name = user_name
         self.bin_path = bin_path
-        self.contact_list = {}
-        self.group_list = {}
-        self.async_loop.run_until_complete(self.__start_signal_cli_subprocess())
-        self.incoming_json_queue = asyncio.Queue( loop=self.async_loop)
-        self.outgoing_json_queue = asyncio.Queue( loop=self.async_loop)
-        self.async_loop.create_task(self.__incoming_json_queue_worker())
-        self.async_loop.create_task(self.__outgoing_json_queue_worker())
+        self.send_timeout = send_timeout
+        self.pending_requests = {}
+        ## written requests waiting for a response, see __wait_for_stream_room()
+        self.requests_in_flight = 0
+        self.request_written = asyncio.Event()
+        self.directory = Signalcli.Directory()
+        self.contact_list = self.directory.contacts
+        self.group_list = self.directory.groups
+        self.directory_cache = None
+        if cache_dir:
+            self.directory_cache = DirectoryCache(DirectoryCache.path_for(cache_dir, user_name))
+            self.__load_directory_cache()
         self.callbacks = {}
+        self.router = Router()
+        self.conversation_queues = {}
+        self.ordered_conversations = ordered_conversations
+        self.owns_callback_executor = False
+        if callback_executor:
+            self.callback_executor = callback_executor
+        elif callback_workers:
+            self.callback_executor = concurrent.futures.ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="signalcli-callback")
+            self.owns_callback_executor = True
+        else:
+            self.callback_executor = None
+        if exit_on_eof is None:
+            ## a loop run by someone else (asyncio.run(), "async with") must not be stopped from under them
+            exit_on_eof = not self.async_loop.is_running()
+        self.exit_on_eof = exit_on_eof
+        self.signal_cli_proc = None
+        self.signalcli_api_ping_task = None
+        self.tasks = []
+        self.outgoing_worker = None
+        self.process_tasks = []
+        self.process_ready = asyncio.Event()
+        self.process_start_time = 0
+        self.auto_restart = auto_restart
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+        self.restart_failures = 0
+        self.restart_info = None
+        self.started = False
+        self.stopped = False
         self.attachmentsPath = None
+        self.attachment_store = AttachmentStore(attachment_staging_dir, max_bytes=attachment_cache_size)
+        self.json_codec = codec.get_codec(json_codec)
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
+        self.metrics_port = metrics_port
+        self.metrics_server_started = False
+        self.metrics_labels = (('account', user_name),)
+        self.alive_ping_timestamp = None
+        self.alive_rtt = None
+        self.journal = None
+        if journal_dir:
+            self.journal = OutboundJournal(OutboundJournal.path_for(journal_dir, user_name), json_codec=self.json_codec, fsync=journal_fsync)
+            self.reqID_counter = self.journal.max_reqID()
+        self.dedupe = None
+        if dedupe_size:
+            self.dedupe = EnvelopeDedupe(dedupe_size, path=EnvelopeDedupe.path_for(dedupe_dir, user_name) if dedupe_dir else None,
+                json_codec=self.json_codec)
+        self.history = None
+        if history_dir:
+            self.history = HistoryStore(HistoryStore.path_for(history_dir, user_name), retention=history_retention, json_codec=self.json_codec)
+        self.message_class = Signalcli.MessageView if message_view else Signalcli.Message
+        self.read_chunk_size = read_chunk_size
+        self.max_frame_size = max_frame_size
+        self.incoming_json_queue = asyncio.Queue(maxsize=incoming_queue_size)
+        self.streams = []
+        ## bounded by outgoing_queue_size together with the requests the worker holds back, see __queue_request()
+        self.outgoing_json_queue = asyncio.Queue()
+        self.outgoing_queue_size = outgoing_queue_size
+        self.unwritten_requests = 0
+        self.outgoing_room = asyncio.Event()
+        self.send_bucket = Signalcli.TokenBucket(send_rate, send_burst) if send_rate else None
+        self.recipient_send_rate = recipient_send_rate
+        self.recipient_send_burst = recipient_send_burst
+        self.recipient_buckets = {}
+        self.reply_coalesce_window = reply_coalesce_window
+        self.reply_coalesce_max_size = reply_coalesce_max_size
+        self.reply_coalesce_separator = reply_coalesce_separator
+        self.coalesced_replies = {}
+        self.broadcasts = []
+        if autostart is None:
+            autostart = not self.async_loop.is_running()
+        if autostart:
+            self.async_loop.run_until_complete(self.start())
 
 